@@ -0,0 +1,229 @@
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from masher import Masher
+from phrase_index import PhraseIndex
+from splitter import combine_videos, run_ffmpeg, split_video_vtt
+from sqlite_database import SqliteDatabase
+
+# every caption lasts this long, its words evenly spread over it
+CUE_SECONDS = 2.0
+CONSONANTS = 'bdfgklmnprstvz'
+VOWELS = 'aeiou'
+
+def make_vocabulary(size, rng):
+    # pronounceable made up words, two or three syllables each
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(CONSONANTS) + rng.choice(VOWELS) for _ in range(rng.randint(2, 3))))
+    return sorted(words)
+
+def sample_words(vocabulary, n, rng):
+    # zipf like, a few words are everywhere and most are rare, as in real captions
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    return rng.choices(vocabulary, weights=weights, k=n)
+
+def format_timestamp(t):
+    return '{:02d}:{:02d}:{:06.3f}'.format(int(t // 3600), int(t % 3600 // 60), t % 60)
+
+def make_vtt(path, n_cues, vocabulary, rng):
+    # YouTube style cues, every word after the first tagged with its start time
+    lines = ['WEBVTT', 'Kind: captions', 'Language: en', '']
+    for i in range(n_cues):
+        s = i * CUE_SECONDS
+        words = sample_words(vocabulary, rng.randint(2, 7), rng)
+        step = CUE_SECONDS / len(words)
+        text = words[0] + ''.join('<{}><c> {}</c>'.format(format_timestamp(s + j * step), word)
+                                  for j, word in enumerate(words) if j > 0)
+        lines += ['{} --> {}'.format(format_timestamp(s), format_timestamp(s + CUE_SECONDS)), text, '']
+
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines))
+
+def make_video(path, duration):
+    run_ffmpeg(['-f', 'lavfi', '-i', 'testsrc=size=640x360:rate=30:duration={}'.format(duration),
+                '-f', 'lavfi', '-i', 'sine=frequency=440:duration={}'.format(duration),
+                '-c:v', 'libx264', '-preset', 'veryfast', '-g', '60', '-pix_fmt', 'yuv420p', '-c:a', 'aac', path])
+
+def make_speech(path, duration):
+    run_ffmpeg(['-f', 'lavfi', '-i', 'sine=frequency=220:duration={}'.format(duration), path])
+
+def make_corpus(root_dir, n_videos, n_cues, vocabulary, rng):
+    # every video shares the same footage, hard linked when possible, only their captions differ
+    source = os.path.join(root_dir, 'source.mp4')
+    make_video(source, n_cues * CUE_SECONDS)
+    for i in range(n_videos):
+        video_id = 'bench{:06d}'.format(i)
+        base_dir = os.path.join(root_dir, 'videos', video_id)
+        os.makedirs(base_dir)
+        try:
+            os.link(source, os.path.join(base_dir, video_id + '.mp4'))
+        except OSError:
+            shutil.copy(source, os.path.join(base_dir, video_id + '.mp4'))
+        make_vtt(os.path.join(base_dir, video_id + '.en.vtt'), n_cues, vocabulary, rng)
+
+def timings(fn, args_list):
+    times = []
+    results = []
+    for args in args_list:
+        start = time.perf_counter()
+        results.append(fn(*args))
+        times.append(time.perf_counter() - start)
+    return times, results
+
+def summary(times):
+    return {
+        'runs': len(times),
+        'total': sum(times),
+        'mean': statistics.mean(times),
+        'median': statistics.median(times),
+        'min': min(times),
+        'max': max(times),
+    }
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.realpath(__file__)),
+                                check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    ffmpeg = subprocess.run(['ffmpeg', '-version'], check=True, stdout=subprocess.PIPE).stdout.decode().split('\n')[0]
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'ffmpeg': ffmpeg,
+        'time': time.time(),
+    }
+
+
+class Benchmark:
+    def __init__(self, sizes=(10, 100), lengths=(4, 16, 64), runs=5, cues=30, vocabulary=2000, seed=0,
+                 smart_cut=True, canonical=False, workers=None):
+        self.sizes = sizes
+        self.lengths = lengths
+        self.runs = runs
+        self.cues = cues
+        self.rng = random.Random(seed)
+        self.vocabulary = make_vocabulary(vocabulary, self.rng)
+        self.smart_cut = smart_cut
+        self.canonical = canonical
+        self.workers = workers
+        self.results = []
+
+    def record(self, stage, times, **params):
+        result = dict(stage=stage, **params, **summary(times))
+        self.results.append(result)
+        print('{:<22}{:<40}{:>9.4f}s mean {:>9.4f}s median ({} runs)'.format(
+            stage, ' '.join('{}={}'.format(k, v) for k, v in params.items()), result['mean'], result['median'],
+            result['runs']), file=sys.stderr, flush=True)
+
+    def sentences(self, n_words):
+        # mostly corpus words, one in ten never seen so some of every plan is synthesized
+        return [' '.join(word if self.rng.random() > 0.1 else 'zz' + word for word in
+                         sample_words(self.vocabulary, n_words, self.rng)) for _ in range(self.runs)]
+
+    def run_corpus(self, root_dir, n_videos):
+        corpus = {'videos': n_videos, 'captions': n_videos * self.cues}
+        make_corpus(root_dir, n_videos, self.cues, self.vocabulary, self.rng)
+
+        db = SqliteDatabase(root_dir=root_dir)
+        db.setup()
+        times, _ = timings(db.populate, [(self.workers,)])
+        self.record('populate', times, **corpus)
+
+        times, _ = timings(PhraseIndex.from_database, [(db,)])
+        self.record('build_index', times, **corpus)
+
+        m = Masher(cache_bytes=None, smart_cut=self.smart_cut, canonical=self.canonical, workers=self.workers,
+                   db='sqlite', root_dir=root_dir)
+        for n_words in self.lengths:
+            times, _ = timings(m.generate_action_plan, [(text,) for text in self.sentences(n_words)])
+            self.record('generate_action_plan', times, words=n_words, **corpus)
+
+        caption_ids = self.rng.sample(sorted(m.index.lengths), min(self.runs, len(m.index.lengths)))
+        times, clips = timings(m.fetch_clip, [(caption_id,) for caption_id in caption_ids])
+        self.record('fetch_clip_cold', times, **corpus)
+        times, _ = timings(m.fetch_clip, [(caption_id,) for caption_id in caption_ids])
+        self.record('fetch_clip_cached', times, **corpus)
+
+        timed = [caption_id for caption_id in caption_ids if caption_id in m.index.timed
+                 and m.index.lengths[caption_id] > 2]
+        times, _ = timings(m.fetch_clip, [(caption_id, 1, m.index.lengths[caption_id] - 2) for caption_id in timed])
+        if times:
+            self.record('fetch_clip_cut', times, **corpus)
+
+        video_path = os.path.join(root_dir, 'source.mp4')
+        split_args = [(video_path, s, s + CUE_SECONDS, os.path.join(root_dir, 'split{}.mp4'.format(i)))
+                      for i, s in enumerate(self.rng.uniform(0, (self.cues - 1) * CUE_SECONDS) for _ in range(self.runs))]
+        times, _ = timings(lambda *args: split_video_vtt(*args, smart=self.smart_cut, canonical=self.canonical), split_args)
+        self.record('split_video_vtt', times, smart=self.smart_cut, canonical=self.canonical)
+
+        return m, clips
+
+    def run_synthesis(self, m, root_dir):
+        speech_path = os.path.join(root_dir, 'speech.wav')
+        make_speech(speech_path, 0.6)
+        words = self.rng.sample(self.vocabulary, self.runs)
+        times, _ = timings(m.sythesizer.sythesize_word,
+                           [(word, os.path.join(root_dir, 'syn{}.mp4'.format(i)), speech_path)
+                            for i, word in enumerate(words)])
+        self.record('sythesize_word', times, canonical=self.canonical)
+
+    def run_combine(self, m, clips, root_dir):
+        for n_clips in self.lengths:
+            inputs = [clips[i % len(clips)] for i in range(n_clips)]
+            times, _ = timings(combine_videos, [(inputs, os.path.join(root_dir, 'combined.mp4'))] * min(self.runs, 3))
+            self.record('combine_videos', times, clips=n_clips, canonical=self.canonical)
+
+    def run(self):
+        with tempfile.TemporaryDirectory(prefix='masher-bench') as tmp_dir:
+            for i, n_videos in enumerate(self.sizes):
+                root_dir = os.path.join(tmp_dir, str(n_videos))
+                os.makedirs(os.path.join(root_dir, 'videos'))
+                m, clips = self.run_corpus(root_dir, n_videos)
+
+                # these do not depend on the corpus size
+                if i == 0:
+                    self.run_synthesis(m, root_dir)
+                    self.run_combine(m, clips, root_dir)
+
+        return {'environment': environment(), 'results': self.results}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Time every stage of a mash on a synthetic corpus')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100], help='corpus sizes in videos (default: 10 100)')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[4, 16, 64],
+                        help='sentence lengths in words (default: 4 16 64)')
+    parser.add_argument('--runs', type=int, default=5, help='timed runs of every stage (default: 5)')
+    parser.add_argument('--cues', type=int, default=30, help='captions per video (default: 30)')
+    parser.add_argument('--vocabulary', type=int, default=2000, help='distinct words of the corpus (default: 2000)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-smart-cut', action='store_true', default=False,
+                        help='always re-encode whole clips instead of stream copying between keyframes')
+    parser.add_argument('--canonical', action='store_true', default=False,
+                        help='encode clips to the canonical mash profile so merging them is a stream copy')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes and threads (default: cpu count)')
+    parser.add_argument('--output', default=None, help='write the JSON results to this file (default: stdout)')
+    args = parser.parse_args()
+
+    b = Benchmark(sizes=args.sizes, lengths=args.lengths, runs=args.runs, cues=args.cues, vocabulary=args.vocabulary,
+                  seed=args.seed, smart_cut=not args.no_smart_cut, canonical=args.canonical, workers=args.workers)
+    results = b.run()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
@@ -0,0 +1,194 @@
+import glob
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+# a clip handed out is never evicted for this long so the mash using it can still read it
+MIN_AGE_BEFORE_EVICTION = 60
+
+class ClipCache:
+    def __init__(self, cache_dir, max_bytes=10 * 1024**3, debug=False, clean=True):
+        # max_bytes=None never evicts anything, clean=False leaves looking for partial files to whoever opened the
+        # cache first (splitter workers open it once each)
+        self.logger = logging.getLogger('clip_cache')
+        self.logger.setLevel(logging.DEBUG)
+
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        # the ledger is shared by every process (masher, splitter workers) using the same cache dir
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(self.cache_dir, 'cache.db'), timeout=60,
+                                    isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS clip (
+                key                TEXT PRIMARY KEY,
+                size               INTEGER NOT NULL,
+                duration           REAL,
+                created            REAL NOT NULL,
+                last_used          REAL NOT NULL,
+                hits               INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        self.conn.execute('CREATE INDEX IF NOT EXISTS clip_last_used_idx ON clip (last_used)')
+
+        if clean:
+            self.remove_partial_files()
+
+        if debug:
+            stream_handler = logging.StreamHandler()
+            stream_handler.setLevel(logging.DEBUG)
+            self.logger.addHandler(stream_handler)
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def source_stamp(full_path):
+        # (size, mtime) of a source video, a video downloaded again gets new clips instead of its stale ones
+        try:
+            stat = os.stat(full_path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    @staticmethod
+    def clip_key(video_path, s, e, params=(), stamp=None):
+        # params holds whatever changes the encoded output (codec settings, profile, cut mode...),
+        # stamp is the source_stamp of the video
+        return ClipCache.make_key(video_path, round(s, 3), round(e, 3), tuple(params), stamp)
+
+    def clip_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.mp4')
+
+    def remove_partial_files(self, max_age=3600):
+        # leftovers of crashed encodes, recent ones may still be written by another process
+        for path in glob.glob(os.path.join(self.cache_dir, '*', '*.tmp*.mp4')):
+            try:
+                if time.time() - os.path.getmtime(path) > max_age:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def get(self, key):
+        path = self.clip_path(key)
+        with self.lock:
+            row = self.conn.execute('SELECT size FROM clip WHERE key = ?', (key,)).fetchone()
+            if row is not None and not os.path.isfile(path):
+                self.conn.execute('DELETE FROM clip WHERE key = ?', (key,))
+                row = None
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self.conn.execute('UPDATE clip SET last_used = ?, hits = hits + 1 WHERE key = ?', (time.time(), key))
+        return path
+
+    def __contains__(self, key):
+        with self.lock:
+            row = self.conn.execute('SELECT 1 FROM clip WHERE key = ?', (key,)).fetchone()
+        return row is not None
+
+    def cached_keys(self, keys):
+        # the subset of keys in the cache, asked in batches rather than one query per key
+        keys = list(keys)
+        found = set()
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i+500]
+            with self.lock:
+                rows = self.conn.execute('SELECT key FROM clip WHERE key IN ({})'.format(','.join('?' * len(batch))),
+                                         batch).fetchall()
+            found.update(row[0] for row in rows)
+        return found
+
+    def duration(self, key):
+        with self.lock:
+            row = self.conn.execute('SELECT duration FROM clip WHERE key = ?', (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def put(self, key, produce):
+        # produce(path) writes the clip to path and returns its duration (or None),
+        # it writes to a temporary file which is only renamed once complete
+        path = self.clip_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp_path = '{}.tmp{}_{}.mp4'.format(path[:-4], os.getpid(), threading.get_ident())
+        try:
+            duration = produce(tmp_path)
+            if not os.path.isfile(tmp_path) or os.path.getsize(tmp_path) == 0:
+                raise RuntimeError('Failed to produce clip {}'.format(key))
+            size = os.path.getsize(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+
+        now = time.time()
+        with self.lock:
+            self.conn.execute("""
+                INSERT OR REPLACE INTO clip (key, size, duration, created, last_used, hits)
+                VALUES (?, ?, ?, ?, ?, 0)
+            """, (key, size, duration, now, now))
+
+        self.evict()
+        return path
+
+    def fetch(self, key, produce):
+        path = self.get(key)
+        if path is None:
+            path = self.put(key, produce)
+        return path
+
+    def evict(self):
+        with self.lock:
+            if self.max_bytes is None:
+                return
+            total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM clip').fetchone()[0]
+            if total <= self.max_bytes:
+                return
+
+            # least recently used first
+            rows = self.conn.execute('SELECT key, size FROM clip WHERE last_used < ? ORDER BY last_used',
+                                     (time.time() - MIN_AGE_BEFORE_EVICTION,))
+            evicted = []
+            for key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                evicted.append(key)
+                total -= size
+
+            for key in evicted:
+                self.conn.execute('DELETE FROM clip WHERE key = ?', (key,))
+                try:
+                    os.remove(self.clip_path(key))
+                except OSError:
+                    pass
+
+        if evicted:
+            self.evictions += len(evicted)
+            self.logger.debug('Evicted %d clips, cache is now %.1f MB', len(evicted), total / 1024**2)
+
+    def stats(self):
+        with self.lock:
+            count, total = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM clip').fetchone()
+        return {
+            'clips': count,
+            'bytes': total,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,262 @@
+import json
+import logging
+import mmap
+import os
+import sys
+import time
+from array import array
+from bisect import bisect_left
+
+from phrase_index import pack_key
+from variants import VariantIndex
+
+# bumped whenever the layout of the files (or the variant keys, see variants.py) changes, older stores have to be
+# compiled again
+STORE_VERSION = 3
+
+# every column of the store is one flat file of native ints or floats, array typecode -> memoryview format
+COLUMNS = {
+    'vocab_offsets': 'q', # byte offsets of each word in vocab.bin, words sorted so a word id is its rank
+    'postings': 'q', # packed (caption_id, index) keys of every word, grouped by word id and sorted
+    'postings_offsets': 'q', # start of each word's keys in postings
+    'caption_ids': 'i', # sorted
+    'caption_offsets': 'q', # start of each caption's words in caption_words
+    'caption_words': 'i', # word ids of every caption in order
+    'durations': 'f', # clip duration of each caption
+    'timed': 'B', # 1 when the caption has word timings
+}
+
+def write_bytes(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def write_column(path, typecode, values):
+    with open(path, 'wb') as f:
+        array(typecode, values).tofile(f)
+
+def map_file(path):
+    # read only shared mapping, every process using the store shares the page cache copy
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return memoryview(b'')
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+def compile_store(db, out_dir):
+    # turns the caption and word tables into the flat files read by CorpusStore
+    start = time.time()
+    os.makedirs(out_dir, exist_ok=True)
+
+    postings = {}
+    captions = {}
+    for caption_id, word, index, length in db.iter_words():
+        keys = postings.get(word)
+        if keys is None:
+            keys = postings[word] = array('q')
+        keys.append(pack_key(caption_id, index))
+
+        words = captions.get(caption_id)
+        if words is None:
+            words = captions[caption_id] = [None] * length
+        words[index] = word
+
+    durations = {}
+    timed = {}
+    for caption_id, duration, has_timings in db.iter_captions():
+        durations[caption_id] = duration
+        timed[caption_id] = 1 if has_timings else 0
+
+    vocab = sorted(postings)
+    word_ids = {word: i for i, word in enumerate(vocab)}
+    encoded = [word.encode('utf-8') for word in vocab]
+
+    columns = {'vocab_offsets': [0], 'postings': array('q'), 'postings_offsets': [0]}
+    for word, data in zip(vocab, encoded):
+        columns['vocab_offsets'].append(columns['vocab_offsets'][-1] + len(data))
+        columns['postings'].extend(sorted(postings[word]))
+        columns['postings_offsets'].append(len(columns['postings']))
+
+    caption_ids = sorted(captions)
+    columns['caption_ids'] = caption_ids
+    columns['caption_offsets'] = [0]
+    columns['caption_words'] = array('i')
+    for caption_id in caption_ids:
+        columns['caption_words'].extend(word_ids[word] for word in captions[caption_id])
+        columns['caption_offsets'].append(len(columns['caption_words']))
+    columns['durations'] = [durations.get(caption_id, 0) for caption_id in caption_ids]
+    columns['timed'] = [timed.get(caption_id, 0) for caption_id in caption_ids]
+
+    # every file is written next to its final name and swapped in, meta.json last,
+    # stores already mapped by running processes keep reading their old files
+    files = [('vocab.bin', lambda path: write_bytes(path, b''.join(encoded)))]
+    # near matches are looked up in a plain dict, a few small keys per word are cheap to load
+    variants = VariantIndex.from_counts((word, len(keys)) for word, keys in postings.items())
+    files.append(('variants.json', lambda path: write_bytes(path, json.dumps(variants.to_json()).encode('utf-8'))))
+    files += [(name + '.bin', lambda path, name=name: write_column(path, COLUMNS[name], columns[name]))
+              for name in COLUMNS]
+    for filename, write in files:
+        write(os.path.join(out_dir, filename + '.tmp'))
+        os.replace(os.path.join(out_dir, filename + '.tmp'), os.path.join(out_dir, filename))
+
+    meta = {
+        'version': STORE_VERSION,
+        'byteorder': sys.byteorder,
+        'words': len(vocab),
+        'captions': len(caption_ids),
+        'postings': len(columns['postings']),
+        'compiled': time.time(),
+    }
+    with open(os.path.join(out_dir, 'meta.json.tmp'), 'w') as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(out_dir, 'meta.json.tmp'), os.path.join(out_dir, 'meta.json'))
+
+    logging.getLogger('store').debug('Compiled %d words, %d captions and %d postings into %s in %.2fs',
+                                     meta['words'], meta['captions'], meta['postings'], out_dir, time.time() - start)
+    return meta
+
+
+class MappedVocab:
+    # sorted words looked up by binary search straight in the mapped file, nothing is loaded up front
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def word(self, word_id):
+        return bytes(self.data[self.offsets[word_id]:self.offsets[word_id + 1]]).decode('utf-8')
+
+    def word_id(self, word):
+        target = word.encode('utf-8')
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if bytes(self.data[self.offsets[mid]:self.offsets[mid + 1]]) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and bytes(self.data[self.offsets[lo]:self.offsets[lo + 1]]) == target:
+            return lo
+        return None
+
+
+class MappedPostings:
+    # word -> sorted packed keys, the part of the dict API PhraseIndex uses
+    def __init__(self, vocab, postings, offsets):
+        self.vocab = vocab
+        self.postings = postings
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.vocab)
+
+    def __contains__(self, word):
+        return self.vocab.word_id(word) is not None
+
+    def __getitem__(self, word):
+        word_id = self.vocab.word_id(word)
+        if word_id is None:
+            raise KeyError(word)
+        return self.postings[self.offsets[word_id]:self.offsets[word_id + 1]]
+
+    def get(self, word, default=None):
+        try:
+            return self[word]
+        except KeyError:
+            return default
+
+
+class MappedColumn:
+    # caption_id -> value of a per caption column, values(position) gives the value at a row of the column
+    def __init__(self, caption_ids, values):
+        self.caption_ids = caption_ids
+        self.values = values
+
+    def position(self, caption_id):
+        i = bisect_left(self.caption_ids, caption_id)
+        if i < len(self.caption_ids) and self.caption_ids[i] == caption_id:
+            return i
+        return None
+
+    def __len__(self):
+        return len(self.caption_ids)
+
+    def __contains__(self, caption_id):
+        return self.position(caption_id) is not None
+
+    def __getitem__(self, caption_id):
+        i = self.position(caption_id)
+        if i is None:
+            raise KeyError(caption_id)
+        return self.values(i)
+
+    def get(self, caption_id, default=None):
+        i = self.position(caption_id)
+        return default if i is None else self.values(i)
+
+
+class MappedFlags(MappedColumn):
+    # set of the caption_ids whose flag is set
+    def __contains__(self, caption_id):
+        i = self.position(caption_id)
+        return i is not None and bool(self.values(i))
+
+
+class CorpusStore:
+    def __init__(self, store_dir):
+        with open(os.path.join(store_dir, 'meta.json')) as f:
+            self.meta = json.load(f)
+        if self.meta['version'] != STORE_VERSION or self.meta['byteorder'] != sys.byteorder:
+            raise ValueError('{} was compiled for another version or platform, compile it again'.format(store_dir))
+
+        self.columns = {name: map_file(os.path.join(store_dir, name + '.bin')).cast(typecode)
+                        for name, typecode in COLUMNS.items()}
+        self.vocab = MappedVocab(map_file(os.path.join(store_dir, 'vocab.bin')), self.columns['vocab_offsets'])
+
+        caption_ids = self.columns['caption_ids']
+        offsets = self.columns['caption_offsets']
+        self.postings = MappedPostings(self.vocab, self.columns['postings'], self.columns['postings_offsets'])
+        self.lengths = MappedColumn(caption_ids, lambda i: offsets[i + 1] - offsets[i])
+        self.durations = MappedColumn(caption_ids, self.columns['durations'].__getitem__)
+        self.timed = MappedFlags(caption_ids, self.columns['timed'].__getitem__)
+
+        with open(os.path.join(store_dir, 'variants.json')) as f:
+            self.variants = VariantIndex(json.load(f))
+
+    def caption_words(self, caption_id):
+        i = self.lengths.position(caption_id)
+        if i is None:
+            return None
+        offsets = self.columns['caption_offsets']
+        return [self.vocab.word(word_id) for word_id in self.columns['caption_words'][offsets[i]:offsets[i + 1]]]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from storage import DATABASES, get_database
+
+    parser = argparse.ArgumentParser(description='Compact memory mapped copy of the caption words')
+    parser.add_argument('action', choices=['compile', 'c', 'info', 'i'],
+                        help="""What to do
+                            compile (c): write the store from the database
+                            info (i): print what the store holds
+                        """)
+    parser.add_argument('--db', choices=DATABASES, default='postgres',
+                        help='caption database, sqlite needs no server (default: postgres)')
+    parser.add_argument('--store', default=None, help='store directory (default: cache/corpus)')
+    args = parser.parse_args()
+
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    store_dir = args.store or os.path.realpath(os.path.join(script_dir, '..', 'cache', 'corpus'))
+    if args.action.startswith('c'):
+        logger = logging.getLogger('store')
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(logging.StreamHandler())
+        compile_store(get_database(args.db, debug=True), store_dir)
+    else:
+        store = CorpusStore(store_dir)
+        size = sum(os.path.getsize(os.path.join(store_dir, f)) for f in os.listdir(store_dir))
+        print('{} words, {} captions, {} postings, {:.1f} MB, compiled {}'.format(
+            store.meta['words'], store.meta['captions'], store.meta['postings'], size / 1024**2,
+            time.ctime(store.meta['compiled'])))
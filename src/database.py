@@ -1,26 +1,92 @@
-import logging
+import contextlib
+import io
 import psycopg2
+import psycopg2.extras
+import psycopg2.pool
 import os
+import threading
+
+from storage import Storage
+from tracing import traced
+from utils import caption_words, clean_caption_text
+
+# schema changes applied in order on top of the tables created by Database.setup,
+# an applied migration must never be edited, add a new one instead
+MIGRATIONS = [
+    (1, """
+        -- caption_id was declared SERIAL which gave it a useless sequence default
+        ALTER TABLE word ALTER COLUMN caption_id DROP DEFAULT;
+        DROP SEQUENCE IF EXISTS word_caption_id_seq;
+    """),
+    (2, """
+        -- covering index so word lookups are index only scans
+        CREATE INDEX IF NOT EXISTS word_word_idx ON word (word) INCLUDE (caption_id, index, length);
+        CREATE INDEX IF NOT EXISTS word_caption_id_index_idx ON word (caption_id, index);
+        ANALYZE word;
+    """),
+    (3, """
+        -- numbers synthesized captions without scanning for the current maximum
+        CREATE SEQUENCE IF NOT EXISTS syn_index_seq;
+        SELECT setval('syn_index_seq', (SELECT COALESCE(MAX(index), 0) + 1 FROM caption WHERE vid_id = 'syn'), false);
+    """),
+    (4, """
+        -- start time of each word of the caption, NULL when the captions have no word timing
+        ALTER TABLE caption ADD COLUMN IF NOT EXISTS word_starts REAL[];
+    """),
+]
+
+# queries the masher runs and the index EXPLAIN has to show for each of them
+INDEX_CHECKS = [
+    ('SELECT word FROM word WHERE word IN %s GROUP BY word', (('the', 'and'),), 'word_word_idx'),
+    ('SELECT * FROM word WHERE word = %s', ('the',), 'word_word_idx'),
+    ('SELECT * FROM word WHERE word = %s AND ((caption_id = %s AND index = %s) OR (caption_id = %s AND index = %s))',
+        ('the', 1, 0, 2, 0), 'word_caption_id_index_idx'),
+    ('SELECT video_path, start_t, end_t, clip_path, word_starts FROM caption WHERE id = %s', (1,), 'caption_pkey'),
+]
+
+class Database(Storage):
+    def __init__(self, debug=False, pool_size=None, root_dir=None):
+        # pool_size connections are shared by the threads of a long running process (see server.py),
+        # everything else uses the single self.conn
+        super().__init__(debug=debug, root_dir=root_dir)
+        params = {'host': '', 'dbname': 'masher', 'user': os.environ['PSQL_USER'], 'password': os.environ['PSQL_PASS']}
+        self.pool = None
+        if pool_size:
+            self.pool = psycopg2.pool.ThreadedConnectionPool(1, pool_size + 1, **params)
+            self.conn = self.pool.getconn()
+        else:
+            self.conn = psycopg2.connect(**params)
+        # self.conn is shared by the threads of the masher, their transactions must not interleave
+        self.conn_lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connection(self):
+        # a connection of the pool for the duration of a read, its transaction is ended before giving it back
+        if self.pool is None:
+            with self.conn_lock:
+                try:
+                    yield self.conn
+                    self.conn.commit()
+                except Exception:
+                    self.conn.rollback()
+                    raise
+            return
 
-from utils import find_vtt_splits, clean_caption_text
-
-class Database:
-    def __init__(self, debug=False):
-        self.logger = logging.getLogger('db')
-        self.logger.setLevel(logging.DEBUG)
-        self.conn = psycopg2.connect(host='',
-                                     dbname='masher',
-                                     user=os.environ['PSQL_USER'],
-                                     password=os.environ['PSQL_PASS'])
-
-        script_dir = os.path.dirname(os.path.realpath(__file__))
-        self.root_dir = os.path.realpath(os.path.join(script_dir, '..'))
-        self.video_dir = os.path.join(self.root_dir, 'videos')
-
-        if debug:
-            stream_handler = logging.StreamHandler()
-            stream_handler.setLevel(logging.DEBUG)
-            self.logger.addHandler(stream_handler)
+        conn = self.pool.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.pool.putconn(conn)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.closeall()
+        else:
+            self.conn.close()
 
     def setup(self):
         cur = self.conn.cursor()
@@ -54,20 +120,66 @@ class Database:
         self.conn.commit()
         cur.close()
 
+        self.migrate()
+
+    def schema_version(self, cur):
+        cur.execute("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)")
+        cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+        return cur.fetchone()[0]
+
+    def migrate(self):
+        cur = self.conn.cursor()
+        version = self.schema_version(cur)
+        self.conn.commit()
+
+        for migration_version, sql in MIGRATIONS:
+            if migration_version <= version:
+                continue
+
+            # each migration is its own transaction, a failure leaves the database at the previous version
+            self.logger.debug('Migrating schema to version %d...', migration_version)
+            cur.execute(sql)
+            cur.execute("INSERT INTO schema_version (version) VALUES (%s)", (migration_version,))
+            self.conn.commit()
+            version = migration_version
+
+        self.logger.debug('Schema is at version %d', version)
+        cur.close()
+
+    def check_indexes(self):
+        cur = self.conn.cursor()
+
+        ok = True
+        for query, args, index_name in INDEX_CHECKS:
+            cur.execute('EXPLAIN ' + query, args)
+            plan = '\n'.join(line for line, in cur.fetchall())
+            if index_name in plan:
+                self.logger.debug('OK %s uses %s', query, index_name)
+            else:
+                ok = False
+                self.logger.warning('%s does not use %s:\n%s', query, index_name, plan)
+
+        self.conn.commit()
+        cur.close()
+        return ok
+
     def drop(self):
         cur = self.conn.cursor()
         cur.execute("DROP TABLE caption CASCADE")
         cur.execute("DROP TABLE word")
+        cur.execute("DROP TABLE IF EXISTS schema_version")
         self.conn.commit()
         cur.close()
 
+    @traced('db')
     def insert_syn(self, text, video_path, duration):
-        cur = self.conn.cursor()
+        with self.conn_lock:
+            cur = self.conn.cursor()
 
-        cur.execute("SELECT COALESCE(MAX(index), 0) FROM caption WHERE vid_id='syn'")
-        syn_id = cur.fetchone()[0] + 1
+            cur.execute("SELECT nextval('syn_index_seq')")
+            syn_id = cur.fetchone()[0]
 
-        self.insert_caption(cur, syn_id, 'syn', 0, duration, text, video_path, video_path, converted=True, priority=10)
+            self.insert_caption(cur, syn_id, 'syn', 0, duration, text, video_path, video_path, converted=True, priority=10)
 
     def insert_caption(self, cur, clip_i, vid_id, start_t, end_t, raw_text, video_path, clip_path, converted=False, priority=100):
         text = clean_caption_text(raw_text)
@@ -90,50 +202,88 @@ class Database:
         if text:
             args = []
             query = "INSERT INTO word (caption_id, word, index, length) VALUES "
-            words = text.split(' ')
+            words = caption_words(text)
             for i, word in enumerate(words):
-                morg = cur.mogrify("(%s,%s,%s,%s)", (db_caption_id, word.replace('.', ''), i, len(words))).decode("utf-8")
+                morg = cur.mogrify("(%s,%s,%s,%s)", (db_caption_id, word, i, len(words))).decode("utf-8")
                 args.append(morg)
             query += ','.join(args)
 
             cur.execute(query)
             self.conn.commit()
 
-    def populate(self):
-        cur = self.conn.cursor()
-
-        video_ids = os.listdir(self.video_dir)
-        for video_index, video_id in enumerate(video_ids):
-            if video_index % 100 == 0:
-                self.logger.debug('Progress Report: %s/%s', video_index+1, len(video_ids))
+    def insert_video_captions(self, cur, rows):
+        # rows already present (same vid_id and index) are skipped so re-running a video is harmless
+        inserted = psycopg2.extras.execute_values(cur, """
+            INSERT INTO caption
+                (index, vid_id, raw_text, text, clip_path, video_path, converted, start_t, end_t, duration, priority,
+                 word_starts)
+            VALUES %s
+            ON CONFLICT (vid_id, index) DO NOTHING
+            RETURNING id, index
+        """, rows, page_size=1000, fetch=True)
+
+        texts = {row[0]: row[3] for row in rows}
+        buf = io.StringIO()
+        n_words = 0
+        for caption_id, index in inserted:
+            words = caption_words(texts[index])
+            for i, word in enumerate(words):
+                buf.write('{}\t{}\t{}\t{}\n'.format(caption_id, word, i, len(words)))
+            n_words += len(words)
 
-            base_dir = os.path.join(self.video_dir, video_id)
-            files = os.listdir(base_dir)
+        # cleaned words only hold [a-z0-9_'] so they never need COPY escaping
+        buf.seek(0)
+        cur.copy_from(buf, 'word', columns=('caption_id', 'word', 'index', 'length'))
 
-            vtt_file = next((os.path.join('videos', video_id, f) for f in files if f.endswith('vtt')), None)
-            video_file = next((os.path.join('videos', video_id, f) for f in files if f == video_id + '.mp4'), None)
+        return len(inserted), n_words
 
-            # if there is not exaclty a VTT and video file, ignore
-            if len(files) < 2 or vtt_file is None or video_file is None:
-                self.logger.debug('Skipping video folder (%s)', base_dir)
-                continue
+    def is_video_ingested(self, video_id):
+        cur = self.conn.cursor()
+        cur.execute('SELECT 1 FROM caption WHERE vid_id = %s LIMIT 1', (video_id,))
+        ingested = cur.fetchone() is not None
+        cur.close()
+        self.conn.commit()
+        return ingested
 
-            splits = find_vtt_splits(os.path.join(self.root_dir, vtt_file), base_dir)
-            for split in splits:
-                i, s, e, raw_text = split
-                clip_path = os.path.join('videos', video_id, "clip{}.mp4".format(i))
-                self.insert_caption(cur, i, video_id, s, e, raw_text, video_file, clip_path)
+    @traced('db')
+    def ingest_video(self, rows):
+        cur = self.conn.cursor()
+        try:
+            n_captions, n_words = self.insert_video_captions(cur, rows)
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cur.close()
+        return n_captions, n_words
 
+    def ingested_counts(self):
+        cur = self.conn.cursor()
+        cur.execute("SELECT vid_id, COUNT(*) FROM caption GROUP BY vid_id")
+        counts = dict(cur.fetchall())
+        self.conn.commit()
         cur.close()
+        return counts
 
-    def find_existing_words(self, words):
+    def delete_video(self, video_id):
         cur = self.conn.cursor()
-        cur.execute('SELECT word FROM word WHERE word IN %s GROUP BY word', (tuple(words), ))
-        data = set(w for w, in cur.fetchall())
+        cur.execute('DELETE FROM word WHERE caption_id IN (SELECT id FROM caption WHERE vid_id = %s)', (video_id,))
+        cur.execute('DELETE FROM caption WHERE vid_id = %s', (video_id,))
+        self.conn.commit()
         cur.close()
 
+    @traced('db')
+    def find_existing_words(self, words):
+        with self.connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT word FROM word WHERE word IN %s GROUP BY word', (tuple(words), ))
+            data = set(w for w, in cur.fetchall())
+            cur.close()
+
         return data
 
+    @traced('db')
     def find_text_range(self, word, caption_index_filters=None, limit=None):
         cur = self.conn.cursor()
 
@@ -159,23 +309,60 @@ class Database:
 
         return data
 
-    def find_caption_info(self, caption_id):
+    def iter_words(self, batch_size=50000):
+        # server side cursor so the whole table is never held in memory at once
+        cur = self.conn.cursor(name='iter_words')
+        cur.itersize = batch_size
+        cur.execute('SELECT caption_id, word, index, length FROM word')
+        for row in cur:
+            yield row
+        cur.close()
+        self.conn.commit()
+
+    def iter_captions(self):
         cur = self.conn.cursor()
-        cur.execute('SELECT video_path, start_t, end_t, clip_path FROM caption WHERE id = %s', (caption_id,))
-        path = cur.fetchone()
+        cur.execute('SELECT id, duration, word_starts IS NOT NULL FROM caption')
+        for row in cur:
+            yield row
         cur.close()
+        self.conn.commit()
+
+    @traced('db')
+    def find_captions_info(self, caption_ids):
+        with self.connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT id, video_path, start_t, end_t, clip_path, word_starts FROM caption WHERE id IN %s',
+                        (tuple(caption_ids),))
+            data = {row[0]: row[1:] for row in cur.fetchall()}
+            cur.close()
+        return data
+
+    @traced('db')
+    def find_caption_info(self, caption_id):
+        with self.connection() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT video_path, start_t, end_t, clip_path, word_starts FROM caption WHERE id = %s',
+                        (caption_id,))
+            path = cur.fetchone()
+            cur.close()
         return path
 
 if __name__ == '__main__':
     import argparse
 
     parser = argparse.ArgumentParser(description='Database for masher')
-    parser.add_argument('action', choices=['setup', 's', 'populate', 'p', 'drop', 'd'],
+    parser.add_argument('action', choices=['setup', 's', 'populate', 'p', 'drop', 'd', 'migrate', 'm', 'explain', 'e'],
                         help="""What to do
                             setup (s): create tables to setup database
                             drop (d): drop tables
                             populate (p): fill database with caption data
+                            migrate (m): upgrade the schema of an existing database
+                            explain (e): check the masher queries use their indexes
                         """)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Processes parsing VTT files when populating (default: cpu count - 1)')
+    parser.add_argument('--full-scan', action='store_true', default=False,
+                        help='look into every video folder when populating, not only the ones changed since the last run')
     args = parser.parse_args()
 
     d = Database(debug=True)
@@ -183,5 +370,10 @@ if __name__ == '__main__':
         d.setup()
     elif args.action.startswith('d'):
         d.drop()
+    elif args.action.startswith('m'):
+        d.migrate()
+    elif args.action.startswith('e'):
+        if not d.check_indexes():
+            raise SystemExit(1)
     else:
-        d.populate()
+        d.populate(workers=args.workers, full_scan=args.full_scan)
@@ -1,42 +1,134 @@
 import logging
 import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import youtube_dl
 
 from youtube_api import youtube_list
 
+# seconds to wait before retrying a failed download, doubled on every attempt
+RETRY_BACKOFF = 30
+
+class Ledger:
+    # state of every video to download, kept on disk so an interrupted run picks up where it stopped
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS video (
+                video_id           TEXT PRIMARY KEY,
+                state              TEXT NOT NULL,
+                attempts           INTEGER NOT NULL DEFAULT 0,
+                next_attempt       REAL NOT NULL DEFAULT 0,
+                error              TEXT,
+                updated            REAL NOT NULL
+            )
+        """)
+        self.conn.execute('CREATE INDEX IF NOT EXISTS video_state_idx ON video (state, next_attempt)')
+        # the videos of the list being downloaded, the ledger also remembers those of earlier lists
+        self.conn.execute('CREATE TEMP TABLE listed (video_id TEXT PRIMARY KEY)')
+
+    def add(self, video_ids):
+        # video_ids becomes the list claim and counts look at, the new ones are pending
+        with self.lock:
+            self.conn.executemany("INSERT OR IGNORE INTO video (video_id, state, updated) VALUES (?, 'pending', ?)",
+                                  [(video_id, time.time()) for video_id in video_ids])
+            self.conn.execute('DELETE FROM listed')
+            self.conn.executemany('INSERT OR IGNORE INTO listed (video_id) VALUES (?)', [(video_id,) for video_id in video_ids])
+
+    def set_state(self, video_id, state, error=None):
+        with self.lock:
+            self.conn.execute('UPDATE video SET state = ?, error = ?, updated = ? WHERE video_id = ?',
+                              (state, error, time.time(), video_id))
+
+    def reset_interrupted(self):
+        # downloads running when a previous run died
+        with self.lock:
+            self.conn.execute("UPDATE video SET state = 'pending' WHERE state = 'downloading'")
+
+    def retry_failed(self):
+        with self.lock:
+            self.conn.execute("UPDATE video SET state = 'pending', attempts = 0, next_attempt = 0 WHERE state = 'failed'")
+
+    def claim(self):
+        # (video_id, wait) with video_id the next listed video to download (now marked as downloading),
+        # None and how long to wait when all that is left is backing off, or (None, None) when nothing is left
+        with self.lock:
+            row = self.conn.execute("""
+                SELECT video_id, next_attempt FROM video JOIN listed USING (video_id)
+                WHERE state = 'pending' ORDER BY next_attempt, video_id LIMIT 1
+            """).fetchone()
+            now = time.time()
+            if row is None:
+                return None, None
+
+            video_id, next_attempt = row
+            if next_attempt > now:
+                return None, next_attempt - now
+
+            self.conn.execute("UPDATE video SET state = 'downloading', updated = ? WHERE video_id = ?", (now, video_id))
+            return video_id, 0
+
+    def failed_attempt(self, video_id, error, max_attempts):
+        with self.lock:
+            attempts = self.conn.execute('SELECT attempts FROM video WHERE video_id = ?', (video_id,)).fetchone()[0] + 1
+            state = 'failed' if attempts >= max_attempts else 'pending'
+            self.conn.execute("""
+                UPDATE video SET state = ?, attempts = ?, next_attempt = ?, error = ?, updated = ? WHERE video_id = ?
+            """, (state, attempts, time.time() + RETRY_BACKOFF * 2**(attempts - 1), error, time.time(), video_id))
+        return state
+
+    def counts(self, listed=False):
+        # videos in every state, of the listed videos only or of the whole ledger
+        with self.lock:
+            rows = self.conn.execute('SELECT state, COUNT(*) FROM video {} GROUP BY state'.format(
+                'JOIN listed USING (video_id)' if listed else '')).fetchall()
+        return dict(rows)
+
+
 class Downloader:
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, workers=4, overwrite=False, max_attempts=3, extractor=None, root_dir=None):
+        # extractor(video_id, url) downloads a video and its subtitles to self.output_dir/video_id,
+        # youtube_dl by default, a stub can be given to test the scheduling without network.
+        # root_dir holds the videos and cache directories, the repository by default
         self.logger = logging.getLogger('downloader')
         self.logger.setLevel(logging.DEBUG)
 
+        self.workers = workers
+        self.overwrite = overwrite
+        self.max_attempts = max_attempts
+        self.extractor = extractor or self.youtube_dl_extract
+
         script_dir = os.path.dirname(os.path.realpath(__file__))
-        self.output_dir = os.path.realpath(os.path.join(script_dir, '..', 'videos'))
-        self.cache_dir = os.path.realpath(os.path.join(script_dir, '..', 'cache'))
+        self.root_dir = root_dir or os.path.realpath(os.path.join(script_dir, '..'))
+        self.output_dir = os.path.join(self.root_dir, 'videos')
+        self.cache_dir = os.path.join(self.root_dir, 'cache')
 
         self.create_dir_if_not_exists(self.output_dir)
         self.create_dir_if_not_exists(self.cache_dir)
 
+        self.ledger = Ledger(os.path.join(self.cache_dir, 'downloads.db'))
+
         if debug:
             stream_handler = logging.StreamHandler()
             stream_handler.setLevel(logging.DEBUG)
             self.logger.addHandler(stream_handler)
 
     def create_dir_if_not_exists(self, path):
-        if not os.path.isdir(path):
-            os.mkdir(path)
+        os.makedirs(path, exist_ok=True)
 
     def get_channel_list_path(self, channel_id):
         return os.path.join(self.cache_dir, '{}.txt'.format(channel_id))
 
     def get_channel_subtitled_vids(self, channel_id):
         channel_list_path = self.get_channel_list_path(channel_id)
-        if os.path.isfile(channel_list_path):
-            x = ''
-            while x not in ['y', 'n']:
-                x = input('Replace existing file for {}? [y/n]'.format(channel_id))
-            if x == 'n':
-                return
+        if os.path.isfile(channel_list_path) and not self.overwrite:
+            self.logger.debug('Keeping existing list for %s (overwrite to replace it)', channel_id)
+            return
 
         self.logger.debug('Downloading subtitles...')
 
@@ -46,20 +138,14 @@ class Downloader:
             f.write(os.linesep.join(vid_ids))
             f.write(os.linesep)
 
-    def download_subtitled_urls(self, batch_file):
-        urls = []
-        with open(batch_file, 'r') as f:
-            for line in f:
-                if not line.startswith('#'):
-                    video_id = line.strip()
-                    video_dir = os.path.join(self.output_dir, video_id)
-                    self.create_dir_if_not_exists(video_dir)
-
-                    if len(os.listdir(video_dir)) < 2:
-                        urls.append('https://www.youtube.com/watch?v={}'.format(video_id))
-
-        self.logger.debug('Downloading {} videos...'.format(len(urls)))
+    def is_downloaded(self, video_id):
+        video_dir = os.path.join(self.output_dir, video_id)
+        if not os.path.isdir(video_dir):
+            return False
+        files = os.listdir(video_dir)
+        return video_id + '.mp4' in files and any(f.endswith('vtt') for f in files)
 
+    def youtube_dl_extract(self, video_id, url):
         ydl_opts = {
             'subtitleslangs': ['en'],
             'subtitlesformat': 'vtt',
@@ -69,16 +155,77 @@ class Downloader:
             'format': 'mp4',
             'outtmpl': '{}{s}%(id)s{s}%(id)s.%(ext)s'.format(self.output_dir, s=os.sep),
             'retries': 2,
+            'quiet': True,
         }
+        # one instance per download, they are not shared between threads
         with youtube_dl.YoutubeDL(ydl_opts) as ydl:
-            ydl.download(urls)
-
-    def download_subtitle_channel(self, channel_id):
+            ydl.download([url])
+
+    def download_worker(self, progress, on_done):
+        while True:
+            video_id, wait = self.ledger.claim()
+            if video_id is None:
+                if wait is None:
+                    return
+                time.sleep(min(wait, 5))
+                continue
+
+            try:
+                self.extractor(video_id, 'https://www.youtube.com/watch?v={}'.format(video_id))
+                if not self.is_downloaded(video_id):
+                    raise RuntimeError('missing video or subtitles after download')
+            except Exception as e:
+                state = self.ledger.failed_attempt(video_id, str(e), self.max_attempts)
+                self.logger.debug('Failed to download %s (%s): %s', video_id, state, e)
+            else:
+                self.ledger.set_state(video_id, 'done')
+                progress(video_id)
+                if on_done is not None:
+                    on_done(video_id)
+
+    def download_subtitled_urls(self, batch_file, on_done=None):
+        # on_done(video_id) is called from the workers for every video of the list once it is on disk
+        video_ids = set()
+        with open(batch_file, 'r') as f:
+            for line in f:
+                if not line.startswith('#') and line.strip():
+                    video_ids.add(line.strip())
+
+        self.ledger.add(video_ids)
+        self.ledger.reset_interrupted()
+        for video_id in video_ids:
+            # downloaded before the ledger existed
+            if self.is_downloaded(video_id):
+                self.ledger.set_state(video_id, 'done')
+                if on_done is not None:
+                    on_done(video_id)
+
+        counts = self.ledger.counts(listed=True)
+        self.logger.debug('Downloading %d videos on %d workers (%s)...', counts.get('pending', 0), self.workers, counts)
+
+        start = time.time()
+        done = []
+        lock = threading.Lock()
+
+        def progress(video_id):
+            with lock:
+                done.append(video_id)
+                elapsed = time.time() - start
+                self.logger.debug('Downloaded %s: %d done in %.0fs (%.1f videos/min)',
+                                  video_id, len(done), elapsed, 60 * len(done) / max(elapsed, 1e-6))
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for future in [pool.submit(self.download_worker, progress, on_done) for _ in range(self.workers)]:
+                future.result()
+
+        self.logger.debug('Download finished: %s', self.ledger.counts(listed=True))
+
+    def download_subtitle_channel(self, channel_id, on_done=None):
         video_urls_file = self.get_channel_list_path(channel_id)
         if not os.path.isfile(video_urls_file):
             self.get_channel_subtitled_vids(channel_id)
 
-        self.download_subtitled_urls(video_urls_file)
+        self.download_subtitled_urls(video_urls_file, on_done=on_done)
 
 
 if __name__ == '__main__':
@@ -91,9 +238,17 @@ if __name__ == '__main__':
                             list (l): create a list of subtitled videos
                         """)
     parser.add_argument('channel_id', help='Channel ID to fetch')
+    parser.add_argument('--workers', type=int, default=4, help='concurrent downloads (default: 4)')
+    parser.add_argument('--overwrite', action='store_true', default=False,
+                        help='replace the existing list of videos of the channel')
+    parser.add_argument('--attempts', type=int, default=3, help='attempts per video before giving up (default: 3)')
+    parser.add_argument('--retry-failed', action='store_true', default=False,
+                        help='try again videos which failed in previous runs')
     args = parser.parse_args()
 
-    d = Downloader(debug=True)
+    d = Downloader(debug=True, workers=args.workers, overwrite=args.overwrite, max_attempts=args.attempts)
+    if args.retry_failed:
+        d.ledger.retry_failed()
     if args.action.startswith('d'):
         d.download_subtitle_channel(args.channel_id)
     else:
@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import os
+import subprocess
+import threading
+
+# longest ffmpeg or ffprobe run before it is killed, None waits forever
+DEFAULT_TIMEOUT = None
+
+class ProcessResult:
+    def __init__(self, cmd, returncode, stdout, stderr, cpu_seconds):
+        self.cmd = cmd
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        # user and system time of the child itself, not of the whole process tree of the caller
+        self.cpu_seconds = cpu_seconds
+
+    def check(self):
+        if self.returncode != 0:
+            raise subprocess.CalledProcessError(self.returncode, self.cmd, output=self.stdout, stderr=self.stderr)
+        return self
+
+
+class FFmpegRunner:
+    # one event loop thread drives every ffmpeg of the process, callers in any thread schedule onto it and at most
+    # max_procs encodes run at once however many mashes, clips and syntheses are waiting on them
+    def __init__(self, max_procs=None, timeout=DEFAULT_TIMEOUT, debug=False):
+        self.logger = logging.getLogger('ffmpeg')
+        self.logger.setLevel(logging.DEBUG)
+
+        self.max_procs = max_procs or os.cpu_count()
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self.loop = asyncio.new_event_loop()
+        self.semaphore = None
+        self.running = {}
+        self.thread = threading.Thread(target=self.loop.run_forever, name='ffmpeg-runner', daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.setup(), self.loop).result()
+
+        if debug:
+            stream_handler = logging.StreamHandler()
+            stream_handler.setLevel(logging.DEBUG)
+            self.logger.addHandler(stream_handler)
+
+    async def setup(self):
+        # the semaphore belongs to the loop it is made in
+        self.semaphore = asyncio.Semaphore(self.max_procs)
+
+    def wait_readable(self, fd):
+        future = self.loop.create_future()
+
+        def ready():
+            self.loop.remove_reader(fd)
+            if not future.done():
+                future.set_result(None)
+
+        self.loop.add_reader(fd, ready)
+        future.add_done_callback(lambda _: self.loop.remove_reader(fd))
+        return future
+
+    async def read_all(self, pipe):
+        if pipe is None:
+            return None
+        fd = pipe.fileno()
+        os.set_blocking(fd, False)
+        chunks = []
+        while True:
+            await self.wait_readable(fd)
+            try:
+                chunk = os.read(fd, 65536)
+            except BlockingIOError:
+                continue
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    async def wait_exit(self, proc):
+        # the child is reaped with wait4 rather than by asyncio so its resource usage is known
+        if hasattr(os, 'pidfd_open'):
+            pidfd = os.pidfd_open(proc.pid)
+            try:
+                await self.wait_readable(pidfd)
+            finally:
+                os.close(pidfd)
+            return os.wait4(proc.pid, 0)
+        return await self.loop.run_in_executor(None, os.wait4, proc.pid, 0)
+
+    def reap(self, proc, status, usage):
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        for pipe in (proc.stdout, proc.stderr):
+            if pipe is not None:
+                pipe.close()
+        return usage.ru_utime + usage.ru_stime
+
+    async def communicate(self, proc):
+        stdout, stderr, (_, status, usage) = await asyncio.gather(
+            self.read_all(proc.stdout), self.read_all(proc.stderr), self.wait_exit(proc))
+        return stdout, stderr, self.reap(proc, status, usage)
+
+    async def run_async(self, cmd, timeout=None, capture_stdout=False):
+        # a ProcessResult, raises TimeoutError after timeout seconds, the process is killed when cancelled or timed out
+        timeout = timeout if timeout is not None else self.timeout
+        async with self.semaphore:
+            proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL,
+                                    stdout=subprocess.PIPE if capture_stdout else subprocess.DEVNULL,
+                                    stderr=subprocess.PIPE)
+            self.running[proc.pid] = cmd
+            try:
+                stdout, stderr, cpu_seconds = await asyncio.wait_for(self.communicate(proc), timeout)
+            except BaseException:
+                if proc.returncode is None:
+                    self.logger.debug('Killing %s', ' '.join(cmd))
+                    proc.kill()
+                    self.reap(proc, *os.wait4(proc.pid, 0)[1:])
+                raise
+            finally:
+                self.running.pop(proc.pid, None)
+        return ProcessResult(cmd, proc.returncode, stdout, stderr, cpu_seconds)
+
+    def submit(self, cmd, timeout=None, capture_stdout=False):
+        # a concurrent.futures.Future of the run, cancelling it kills the process
+        return asyncio.run_coroutine_threadsafe(self.run_async(cmd, timeout, capture_stdout), self.loop)
+
+    def run(self, cmd, timeout=None, capture_stdout=False):
+        # blocks the calling thread only, the process is killed if the caller is interrupted
+        future = self.submit(cmd, timeout, capture_stdout)
+        try:
+            return future.result()
+        except BaseException:
+            future.cancel()
+            raise
+
+    def stats(self):
+        return {'max_procs': self.max_procs, 'running': len(self.running), 'timeout': self.timeout}
+
+
+runner = None
+runner_lock = threading.Lock()
+
+def get_runner():
+    # the runner of this process, a forked worker starts its own as the loop thread does not survive the fork
+    global runner
+    with runner_lock:
+        if runner is None or runner.pid != os.getpid():
+            runner = FFmpegRunner()
+        return runner
+
+def configure(max_procs=None, timeout=DEFAULT_TIMEOUT, debug=False):
+    global runner
+    with runner_lock:
+        runner = FFmpegRunner(max_procs=max_procs, timeout=timeout, debug=debug)
+        return runner
@@ -0,0 +1,200 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+class Manifest:
+    # what is known about every video folder, so re-runs only look at the folders which changed
+    def __init__(self, root_dir, debug=False):
+        self.logger = logging.getLogger('manifest')
+        self.logger.setLevel(logging.DEBUG)
+
+        self.root_dir = root_dir
+        self.video_dir = os.path.join(root_dir, 'videos')
+        cache_dir = os.path.join(root_dir, 'cache')
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(cache_dir, 'manifest.db'), timeout=60,
+                                    isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS video (
+                video_id           TEXT PRIMARY KEY,
+                dir_mtime          REAL NOT NULL,
+                video_size         INTEGER,
+                video_mtime        REAL,
+                vtt_file           TEXT,
+                vtt_size           INTEGER,
+                vtt_mtime          REAL,
+                vtt_hash           TEXT,
+                ingested_hash      TEXT,
+                n_captions         INTEGER,
+                split_source       TEXT,
+                split_params       TEXT,
+                n_clips            INTEGER,
+                updated            REAL NOT NULL
+            )
+        """)
+
+        if debug:
+            stream_handler = logging.StreamHandler()
+            stream_handler.setLevel(logging.DEBUG)
+            self.logger.addHandler(stream_handler)
+
+    def known_videos(self):
+        with self.lock:
+            rows = self.conn.execute("""
+                SELECT video_id, dir_mtime, vtt_size, vtt_mtime, vtt_hash, vtt_file, video_size, video_mtime FROM video
+            """).fetchall()
+        return {row[0]: row[1:] for row in rows}
+
+    def files_unchanged(self, base_dir, video_id, known):
+        # files edited or replaced in place leave the folder mtime alone, their own size and mtime do not
+        _, vtt_size, vtt_mtime, _, vtt_file, video_size, video_mtime = known
+        for name, size, mtime in ((video_id + '.mp4', video_size, video_mtime), (vtt_file, vtt_size, vtt_mtime)):
+            if name is None or size is None:
+                continue
+            try:
+                st = os.stat(os.path.join(base_dir, name))
+            except OSError:
+                return False
+            if (st.st_size, st.st_mtime) != (size, mtime):
+                return False
+        return True
+
+    def scan(self, full=False, fast=False):
+        # a folder with no file added or removed (same mtime) and its video and captions unchanged (same size and
+        # mtime) is not listed again. fast=True trusts the folder mtime alone, missing files changed in place,
+        # full=True looks into every folder anyway
+        start = time.time()
+        known = self.known_videos()
+        present = set()
+        changed = []
+        for entry in os.scandir(self.video_dir):
+            if not entry.is_dir() or entry.name == 'syn':
+                continue
+            present.add(entry.name)
+
+            dir_mtime = entry.stat().st_mtime
+            if not full and entry.name in known and known[entry.name][0] == dir_mtime and (
+                    fast or self.files_unchanged(entry.path, entry.name, known[entry.name])):
+                continue
+
+            self.refresh(entry.name, dir_mtime, known.get(entry.name))
+            changed.append(entry.name)
+
+        removed = set(known) - present
+        with self.lock:
+            self.conn.executemany('DELETE FROM video WHERE video_id = ?', [(video_id,) for video_id in removed])
+
+        self.logger.debug('Scanned %d video folders in %.2fs: %d new or changed, %d removed',
+                          len(present), time.time() - start, len(changed), len(removed))
+        return changed
+
+    def refresh(self, video_id, dir_mtime=None, previous=None):
+        base_dir = os.path.join(self.video_dir, video_id)
+        if dir_mtime is None:
+            dir_mtime = os.stat(base_dir).st_mtime
+        files = os.listdir(base_dir)
+
+        video_size = video_mtime = None
+        if video_id + '.mp4' in files:
+            st = os.stat(os.path.join(base_dir, video_id + '.mp4'))
+            video_size, video_mtime = st.st_size, st.st_mtime
+
+        vtt_file = next((f for f in files if f.endswith('vtt')), None)
+        vtt_size = vtt_mtime = vtt_hash = None
+        if vtt_file is not None:
+            st = os.stat(os.path.join(base_dir, vtt_file))
+            vtt_size, vtt_mtime = st.st_size, st.st_mtime
+            if previous is not None and previous[1:3] == (vtt_size, vtt_mtime):
+                vtt_hash = previous[3]
+            else:
+                with open(os.path.join(base_dir, vtt_file), 'rb') as f:
+                    vtt_hash = hashlib.sha1(f.read()).hexdigest()
+
+        with self.lock:
+            self.conn.execute("""
+                INSERT INTO video (video_id, dir_mtime, video_size, video_mtime, vtt_file, vtt_size, vtt_mtime, vtt_hash, updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (video_id) DO UPDATE SET
+                    dir_mtime = excluded.dir_mtime, video_size = excluded.video_size, video_mtime = excluded.video_mtime,
+                    vtt_file = excluded.vtt_file, vtt_size = excluded.vtt_size, vtt_mtime = excluded.vtt_mtime,
+                    vtt_hash = excluded.vtt_hash, updated = excluded.updated
+            """, (video_id, dir_mtime, video_size, video_mtime, vtt_file, vtt_size, vtt_mtime, vtt_hash, time.time()))
+
+    def complete_videos(self):
+        # (video_id, vtt_hash, ingested_hash) of every folder holding both a video and its captions
+        with self.lock:
+            return self.conn.execute("""
+                SELECT video_id, vtt_hash, ingested_hash FROM video WHERE video_size IS NOT NULL AND vtt_hash IS NOT NULL
+            """).fetchall()
+
+    def mark_ingested(self, video_id, n_captions):
+        with self.lock:
+            self.conn.execute('UPDATE video SET ingested_hash = vtt_hash, n_captions = ?, updated = ? WHERE video_id = ?',
+                              (n_captions, time.time(), video_id))
+
+    def pending_split(self, params):
+        # videos never split with params, or whose video or captions changed since
+        with self.lock:
+            return [video_id for video_id, in self.conn.execute("""
+                SELECT video_id FROM video
+                WHERE video_size IS NOT NULL AND vtt_hash IS NOT NULL AND (
+                    split_source IS NULL OR split_params IS NOT ?
+                    OR split_source != vtt_hash || ':' || video_size || ':' || video_mtime
+                )
+            """, (params,))]
+
+    def mark_split(self, video_id, params, n_clips):
+        with self.lock:
+            self.conn.execute("""
+                UPDATE video SET split_source = vtt_hash || ':' || video_size || ':' || video_mtime,
+                                 split_params = ?, n_clips = ?, updated = ?
+                WHERE video_id = ?
+            """, (params, n_clips, time.time(), video_id))
+
+    def status(self):
+        with self.lock:
+            row = self.conn.execute("""
+                SELECT COUNT(*),
+                       COUNT(video_size),
+                       COUNT(vtt_hash),
+                       SUM(video_size IS NOT NULL AND vtt_hash IS NOT NULL),
+                       SUM(ingested_hash IS NOT NULL AND ingested_hash = vtt_hash),
+                       SUM(ingested_hash IS NOT NULL AND ingested_hash != vtt_hash),
+                       COALESCE(SUM(n_captions), 0),
+                       COUNT(split_source),
+                       COALESCE(SUM(n_clips), 0),
+                       COALESCE(SUM(video_size), 0)
+                FROM video
+            """).fetchone()
+        keys = ['folders', 'videos', 'captions_files', 'complete', 'ingested', 'changed_since_ingest',
+                'ingested_captions', 'split', 'split_clips', 'video_bytes']
+        return dict(zip(keys, [value or 0 for value in row]))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Corpus manifest')
+    parser.add_argument('action', choices=['status', 's', 'scan'],
+                        help="""What to do
+                            status (s): print corpus statistics from the manifest
+                            scan: update the manifest with new or changed video folders
+                        """)
+    parser.add_argument('--full', action='store_true', default=False, help='look into every folder when scanning')
+    parser.add_argument('--fast', action='store_true', default=False,
+                        help='only look into folders whose mtime changed, files edited in place are missed')
+    args = parser.parse_args()
+
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    m = Manifest(os.path.realpath(os.path.join(script_dir, '..')), debug=True)
+    if args.action == 'scan':
+        m.scan(full=args.full, fast=args.fast)
+    else:
+        for key, value in m.status().items():
+            print('{:<22}{}'.format(key, value))
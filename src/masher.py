@@ -1,155 +1,257 @@
 import logging
-import random
 import os
-
-from database import Database
-from splitter import combine_videos, split_video_vtt
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from clip_cache import ClipCache
+import ffmpeg_runner
+from phrase_index import PhraseIndex
+from planner import CostModel, Planner
+from query_log import QueryLog
+from splitter import clip_params, combine_videos, split_video_vtt
+from storage import DATABASES, get_database
 from synthesizer import Synthesizer
-from utils import clean_caption_text
+from tracing import file_size, trace_summary, tracer
+from tts import BACKENDS
+from utils import caption_words, clean_caption_text, cut_times
+from variants import DEFAULT_TIERS, TIERS
 
 class Masher:
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, cache_bytes=10 * 1024**3, smart_cut=True, canonical=False, workers=None,
+                 tts='gtts', db='postgres', db_pool=None, store=None, root_dir=None, variants=DEFAULT_TIERS):
+        # root_dir holds the videos and cache directories, the repository by default
         self.logger = logging.getLogger('mash')
         self.logger.setLevel(logging.DEBUG)
-        self.db = Database(debug=debug)
-        self.sythesizer = Synthesizer(debug=debug)
-
         script_dir = os.path.dirname(os.path.realpath(__file__))
-        self.root_dir = os.path.realpath(os.path.join(script_dir, '..'))
+        self.root_dir = root_dir or os.path.realpath(os.path.join(script_dir, '..'))
+
+        self.db = get_database(db, debug=debug, pool_size=db_pool, root_dir=self.root_dir)
+        self.sythesizer = Synthesizer(debug=debug, canonical=canonical, tts=tts, root_dir=self.root_dir)
         self.syth_dir = os.path.join(self.root_dir, 'videos', 'syn')
 
         if not os.path.isdir(self.syth_dir):
             os.mkdir(self.syth_dir)
 
+        self.smart_cut = smart_cut
+        self.canonical = canonical
+        self.clip_cache = ClipCache(os.path.join(self.root_dir, 'cache', 'clips'), cache_bytes, debug=debug)
+        self.query_log = QueryLog(os.path.join(self.root_dir, 'cache', 'queries.db'))
+
+        # the heavy lifting happens in ffmpeg subprocesses (and TTS requests) so threads are enough to keep every core busy,
+        # the shared ffmpeg runner caps how many encodes actually run at once
+        self.encode_pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+        self.synth_pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count())
+        self.in_flight = {}
+        self.in_flight_lock = threading.RLock()
+
         if debug:
             stream_handler = logging.StreamHandler()
             stream_handler.setLevel(logging.DEBUG)
             self.logger.addHandler(stream_handler)
 
-    def max_word_range(self, words, start_index, db_words):
-        ranges = []
-
-        possible_words = self.db.find_text_range(words[start_index])
-        j = start_index
-
-        self.logger.debug('Got %s words at first level for %s', len(possible_words), words[start_index])
-
-        while possible_words:
-            random.shuffle(possible_words) # prevent the same clip from always being picked
-            ranges.append(possible_words)
-
-            j += 1
-            if j >= len(words) or not db_words[j]:
-                break
-
-            filters = []
-            for word_row in possible_words:
-                _, caption_id, _, index, _ = word_row
-                filters.append((caption_id, index+1))
+        # built once (or mapped from a compiled store), every phrase lookup afterwards is local
+        self.index = PhraseIndex.from_store(store) if store else PhraseIndex.from_database(self.db)
+        self.planner = Planner(self.index, CostModel(smart_cut=smart_cut), self.cached_clips, self.cached_cuts,
+                               self.cached_synth, variants=variants, debug=debug)
+
+    def clip_key(self, video_path, start_t, end_t, stamps=None):
+        # stamps memoizes the source stamp of every video when many keys are made at once
+        if stamps is None:
+            stamp = ClipCache.source_stamp(os.path.join(self.root_dir, video_path))
+        else:
+            if video_path not in stamps:
+                stamps[video_path] = ClipCache.source_stamp(os.path.join(self.root_dir, video_path))
+            stamp = stamps[video_path]
+        return ClipCache.clip_key(video_path, start_t, end_t, clip_params(self.smart_cut, self.canonical), stamp)
+
+    def ready_clip(self, video_path, clip_path):
+        # synthesized captions are their own clip (never in the canonical profile). The clip{i}.mp4 files older
+        # splitters left next to their video are not trusted, captions have been renumbered since
+        full_clip_path = os.path.join(self.root_dir, clip_path)
+        if not self.canonical and clip_path == video_path and os.path.isfile(full_clip_path):
+            return full_clip_path
+        return None
 
-            possible_words = self.db.find_text_range(words[j], caption_index_filters=filters)
+    def cached_clips(self, caption_ids):
+        # one query for the captions and one for the cache, however many captions the planner asks about
+        cached = set()
+        keys = {}
+        stamps = {}
+        for caption_id, (video_path, start_t, end_t, clip_path, _) in self.db.find_captions_info(caption_ids).items():
+            if self.ready_clip(video_path, clip_path):
+                cached.add(caption_id)
+            else:
+                keys[self.clip_key(video_path, start_t, end_t, stamps)] = caption_id
+        cached.update(keys[key] for key in self.clip_cache.cached_keys(keys))
+        return cached
+
+    def cached_cuts(self, cuts):
+        # the subset of (caption_id, first, last) cuts already made, batched like cached_clips
+        infos = self.db.find_captions_info({caption_id for caption_id, _, _ in cuts})
+        keys = {}
+        stamps = {}
+        for caption_id, first, last in cuts:
+            video_path, _, end_t, _, word_starts = infos.get(caption_id, (None,) * 5)
+            if word_starts:
+                start_t, end_t = cut_times(word_starts, end_t, first, last)
+                keys[self.clip_key(video_path, start_t, end_t, stamps)] = (caption_id, first, last)
+        return {keys[key] for key in self.clip_cache.cached_keys(keys)}
+
+    def cached_synth(self, text):
+        return self.sythesizer.cache_key(text) in self.sythesizer.cache
+
+    def text_words(self, text):
+        return caption_words(clean_caption_text(text).replace('.', ''))
 
-        return ranges
+    def generate_action_plan(self, text):
+        words = self.text_words(text)
 
-    def lucky_check(self, ranges):
-        for i in range(len(ranges)-1, -1, -1):
-            range_size = i+1
-            for word_row in ranges[i]:
-                _, caption_id, _, _, length = word_row
-                if length == range_size: # happy !!! :)
-                    return {
-                        'name': 'clip',
-                        'caption_id': caption_id,
-                        'size': range_size,
-                    }
-        return None
+        self.logger.debug('Starting long search for "%s"', ' '.join(words))
+        actions = self.planner.plan(words)
 
-    def generate_action_plan(self, text):
-        clean = clean_caption_text(text).replace('.', '')
-        words = clean.split(' ')
-        existing_words = self.db.find_existing_words(words)
-        db_words = [word in existing_words for word in words]
-
-        self.logger.debug('Starting long search for "%s"', clean)
-        self.logger.debug('DB WORDS: %s', ','.join(str(x) for x in db_words))
-
-        i = 0
-        # 's' -> sythesize, 'c' -> got full clip, 'g' -> split clip needed
-        actions = []
-        while i < len(words):
-            if db_words[i]:
-                word_ranges = self.max_word_range(words, i, db_words)
-                full_clip = self.lucky_check(word_ranges)
-
-                if full_clip is not None:
-                    skipped_words = words[i:i+full_clip['size']]
-                    self.logger.debug('--> We got lucky! %s skipped (%s)! :)', full_clip['size'], ' '.join(skipped_words))
-                    actions.append(full_clip)
-                    i += full_clip['size']
-                else:
-                    self.logger.debug('--> Lots of work ahead for %s clips', len(word_ranges))
-                    actions.append({
-                        'name': 'sythesize', # 'name': 'generate',
-                        'words': words[i:i+len(word_ranges)], # 'ranges': word_ranges,
-                    })
-                    i += len(word_ranges)
+        for action in actions:
+            if 'near' in action:
+                self.logger.debug('--> Near match "%s"', ' '.join(action['near']))
+            if action['name'] == 'clip':
+                self.logger.debug('--> Clip %s for %s word(s)', action['caption_id'], action['size'])
+            elif action['name'] == 'cut':
+                self.logger.debug('--> Cutting words %s-%s of %s', action['first'], action['last'], action['caption_id'])
             else:
-                range_start = i
-                while i < len(words) and not db_words[i]:
-                    i += 1
-
-                self.logger.debug('--> Sythesizing %d word(s)', i-range_start)
-                actions.append({
-                    'name': 'sythesize',
-                    'words': words[range_start:i],
-                })
+                self.logger.debug('--> Sythesizing "%s"', ' '.join(action['words']))
 
         return actions
 
-    def sythesize_words(self, words):
+    def sythesize_chunks(self, words):
+        return [' '.join(words[i:i+2]) for i in range(0, len(words), 2)]
+
+    def sythesize_texts(self, texts, pool=None):
         clips = []
-        for i in range(0, len(words), 2):
-            text = ' '.join(words[i:i+2])
-            video_path = os.path.join('videos', 'syn', '{}.mp4'.format(text.replace("'", '').replace(' ', '_')))
-            full_path = os.path.join(self.root_dir, video_path)
-
-            print(text, full_path)
-            duration = self.sythesizer.sythesize_word(text, full_path)
-            self.db.insert_syn(text, video_path, duration)
+        for text, (full_path, duration, created) in zip(texts, self.sythesizer.fetch_many(texts, pool)):
+            # only register a syn caption the first time the text is synthesized
+            if created:
+                print(text, full_path)
+                self.db.insert_syn(text, os.path.relpath(full_path, self.root_dir), duration)
             clips.append(full_path)
         return clips
 
-    def fetch_clip(self, caption_id):
+    def sythesize_words(self, words):
+        return self.sythesize_texts(self.sythesize_chunks(words))
+
+    def sythesize_batch(self, futures):
+        try:
+            # renders go to the encode pool, its tasks never wait on the synthesis pool so it cannot deadlock
+            for future, clip in zip(futures.values(), self.sythesize_texts(list(futures), self.encode_pool)):
+                future.set_result(clip)
+        except Exception as e:
+            for future in futures.values():
+                if not future.done():
+                    future.set_exception(e)
+
+    def submit_sythesis(self, texts):
+        # texts already in flight are shared, the others go to the TTS engine in one batch when it batches
+        # (espeak) and one task each otherwise, so slow calls (gTTS) run side by side
+        futures = {}
+        batch = {}
+        with self.in_flight_lock:
+            for text in texts:
+                key = ('syn', text)
+                if key not in self.in_flight:
+                    future = batch[text] = self.in_flight[key] = Future()
+                    future.add_done_callback(lambda _, key=key: self.forget(key))
+                futures[text] = self.in_flight[key]
+
+        if batch and self.sythesizer.tts.batches:
+            self.synth_pool.submit(self.sythesize_batch, batch)
+        else:
+            for text, future in batch.items():
+                self.synth_pool.submit(self.sythesize_batch, {text: future})
+        return futures
+
+    def clip_range(self, caption_id, first=None, last=None):
+        # (video path, start, end, ready made clip path or None) of a clip, first and last select a range of words
+        # of a caption with word timings instead of all of it
+        realtive_video_path, start_t, end_t, relative_clip_path, word_starts = self.db.find_caption_info(caption_id)
+
+        if first is not None:
+            start_t, end_t = cut_times(word_starts, end_t, first, last)
+            return realtive_video_path, start_t, end_t, None
+
+        return realtive_video_path, start_t, end_t, self.ready_clip(realtive_video_path, relative_clip_path)
+
+    def is_clip_cached(self, caption_id, first=None, last=None):
+        realtive_video_path, start_t, end_t, ready_path = self.clip_range(caption_id, first, last)
+        return ready_path is not None or self.clip_key(realtive_video_path, start_t, end_t) in self.clip_cache
+
+    def fetch_clip(self, caption_id, first=None, last=None):
         self.logger.debug('Fetching %s', caption_id)
-        realtive_video_path, start_t, end_t, relative_clip_path = self.db.find_caption_info(caption_id)
-
-        full_clip_path = os.path.join(self.root_dir, relative_clip_path)
-        if not os.path.isfile(full_clip_path):
-            self.logger.debug('Spliting %s...', caption_id)
-            full_video_path = os.path.join(self.root_dir, realtive_video_path)
-            split_video_vtt(full_video_path, start_t, end_t, full_clip_path)
-
-        return full_clip_path
+        with tracer.span('fetch_clip', 'clip', caption_id=caption_id, first=first, last=last) as attrs:
+            realtive_video_path, start_t, end_t, ready_path = self.clip_range(caption_id, first, last)
+            attrs['cache_hit'] = True
+            if ready_path is not None:
+                return ready_path
+
+            def split(clip_path):
+                self.logger.debug('Spliting %s...', caption_id)
+                attrs['cache_hit'] = False
+                full_video_path = os.path.join(self.root_dir, realtive_video_path)
+                return split_video_vtt(full_video_path, start_t, end_t, clip_path, smart=self.smart_cut, canonical=self.canonical)
+
+            clip_path = self.clip_cache.fetch(self.clip_key(realtive_video_path, start_t, end_t), split)
+            tracer.count('clip.cache_hits' if attrs['cache_hit'] else 'clip.cache_misses')
+            return clip_path
+
+    def submit(self, pool, key, fn, *args):
+        # a clip already being made (by this mash or a concurrent one) is waited on rather than made twice
+        with self.in_flight_lock:
+            future = self.in_flight.get(key)
+            if future is None:
+                future = pool.submit(fn, *args)
+                self.in_flight[key] = future
+                future.add_done_callback(lambda _: self.forget(key))
+        return future
+
+    def forget(self, key):
+        with self.in_flight_lock:
+            self.in_flight.pop(key, None)
 
     def acquire_clips(self, actions):
         self.logger.debug('Acquiring clips for %s actions', len(actions))
-        clips = []
+        syn_futures = self.submit_sythesis([text for action in actions if action['name'] == 'sythesize'
+                                            for text in self.sythesize_chunks(action['words'])])
+
+        futures = []
         for action in actions:
             if action['name'] == 'sythesize':
-                clips += self.sythesize_words(action['words'])
+                futures += [syn_futures[text] for text in self.sythesize_chunks(action['words'])]
             elif action['name'] == 'clip':
-                clips.append(self.fetch_clip(action['caption_id']))
-        return clips
+                caption_id = action['caption_id']
+                futures.append(self.submit(self.encode_pool, ('clip', caption_id), self.fetch_clip, caption_id))
+            elif action['name'] == 'cut':
+                key = ('cut', action['caption_id'], action['first'], action['last'])
+                futures.append(self.submit(self.encode_pool, key, self.fetch_clip, *key[1:]))
+
+        return [future.result() for future in futures]
 
     def merge_clips(self, clips, output):
         self.logger.debug('Merging %s clips...', len(clips))
-        combine_videos(clips, output)
+        with tracer.span('merge_clips', 'merge', clips=len(clips)) as attrs:
+            combine_videos(clips, output)
+            attrs['bytes_out'] = file_size(output)
         print('Done! :) Check {}'.format(output))
 
     def mash(self, text, output):
-        actions = self.generate_action_plan(text)
-        clips = self.acquire_clips(actions)
-        self.merge_clips(clips, output)
+        # counters are process wide, concurrent mashes of a server show up in each other's deltas
+        before = tracer.snapshot()
+        with tracer.span('mash', 'mash', text=text):
+            actions = self.generate_action_plan(text)
+            self.query_log.record(text, self.text_words(text), actions)
+            clips = self.acquire_clips(actions)
+            self.merge_clips(clips, output)
+        self.logger.debug('Clip cache: %s', self.clip_cache.stats())
+        self.logger.debug('Synthesis cache: %s', self.sythesizer.cache.stats())
+        if tracer.enabled:
+            self.logger.debug('Trace counters: %s', trace_summary(tracer.snapshot() - before))
+        return output
 
 
 if __name__ == '__main__':
@@ -159,9 +261,39 @@ if __name__ == '__main__':
     parser.add_argument('text', help='text')
     parser.add_argument('output', help='MP4 file path (default: "out.mp4")',
                         nargs='?', default='out.mp4')
+    parser.add_argument('--cache-gb', type=float, default=10, help='clip cache size budget in GB (default: 10)')
+    parser.add_argument('--no-smart-cut', action='store_true', default=False,
+                        help='always re-encode whole clips instead of stream copying between keyframes')
+    parser.add_argument('--canonical', action='store_true', default=False,
+                        help='encode clips to the canonical mash profile so merging them is a stream copy')
+    parser.add_argument('--workers', type=int, default=None, help='clips split in parallel (default: cpu count)')
+    parser.add_argument('--tts', choices=sorted(BACKENDS), default='gtts', help='text to speech engine (default: gtts)')
+    parser.add_argument('--db', choices=DATABASES, default='postgres',
+                        help='caption database, sqlite needs no server (default: postgres)')
+    parser.add_argument('--store', default=None,
+                        help='compiled corpus store to look phrases up in instead of loading them from the database')
+    parser.add_argument('--exact', action='store_true', default=False,
+                        help='only use clips of the exact words, never near matches like "run" for "running"')
+    parser.add_argument('--sound-alikes', action='store_true', default=False,
+                        help='also use words that sound and are spelled alike, like "color" for "colour"')
+    parser.add_argument('--ffmpeg-procs', type=int, default=None, help='ffmpeg processes run at once (default: cpu count)')
+    parser.add_argument('--ffmpeg-timeout', type=float, default=None, help='seconds before an ffmpeg run is killed (default: none)')
+    parser.add_argument('--trace', default=None,
+                        help='write spans of every DB query, ffmpeg run, TTS call and merge to this file')
+    parser.add_argument('--trace-format', choices=('chrome', 'json'), default='chrome',
+                        help='chrome trace (chrome://tracing, ui.perfetto.dev) or plain JSON (default: chrome)')
     parser.add_argument('--debug', action='store_true', default=False)
     args = parser.parse_args()
 
-    m = Masher(debug=args.debug)
-    m.mash(args.text, args.output)
+    if args.trace:
+        tracer.enable()
+    ffmpeg_runner.configure(max_procs=args.ffmpeg_procs, timeout=args.ffmpeg_timeout, debug=args.debug)
+    m = Masher(debug=args.debug, cache_bytes=int(args.cache_gb * 1024**3), smart_cut=not args.no_smart_cut,
+               canonical=args.canonical, workers=args.workers, tts=args.tts, db=args.db, store=args.store,
+               variants=() if args.exact else TIERS if args.sound_alikes else DEFAULT_TIERS)
+    try:
+        m.mash(args.text, args.output)
+    finally:
+        if args.trace:
+            tracer.write(args.trace, chrome=args.trace_format == 'chrome')
 
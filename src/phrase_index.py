@@ -0,0 +1,126 @@
+import logging
+import random
+import time
+from array import array
+from bisect import bisect_left
+
+from variants import DEFAULT_TIERS, VariantIndex
+
+# a word position is packed into a single int64 as (caption_id << KEY_SHIFT) | index
+# so a word's postings form one flat sorted array and "the next word of the same
+# caption" is simply key + 1
+KEY_SHIFT = 20
+INDEX_MASK = (1 << KEY_SHIFT) - 1
+
+def pack_key(caption_id, index):
+    return (caption_id << KEY_SHIFT) | index
+
+def unpack_key(key):
+    return key >> KEY_SHIFT, key & INDEX_MASK
+
+def contains_sorted(values, value):
+    i = bisect_left(values, value)
+    return i < len(values) and values[i] == value
+
+def intersect_next(keys, postings):
+    # the postings right after one of keys (the next word of the same caption), the longer of the two is probed
+    # with every element of the shorter one, much cheaper than a linear merge when a common word meets a rare one
+    if len(keys) <= len(postings):
+        return [key + 1 for key in keys if contains_sorted(postings, key + 1)]
+    return [key for key in postings if contains_sorted(keys, key - 1)]
+
+def sample_keys(keys, n):
+    # up to n of keys in random order, without copying all of them
+    return [keys[i] for i in random.sample(range(len(keys)), min(n, len(keys)))]
+
+
+class PhraseIndex:
+    def __init__(self, postings, lengths, durations=None, timed=None, variants=None):
+        self.logger = logging.getLogger('index')
+        self.postings = postings # word -> sorted array of packed (caption_id, index)
+        self.lengths = lengths # caption_id -> number of words in caption
+        self.durations = durations or {} # caption_id -> clip duration in seconds
+        self.timed = timed or set() # caption_ids with word timings, their words can be cut out
+        self.variants = variants # near matches of words the corpus lacks, see variants.py
+
+    @classmethod
+    def from_rows(cls, rows):
+        postings = {}
+        lengths = {}
+        for caption_id, word, index, length in rows:
+            keys = postings.get(word)
+            if keys is None:
+                keys = postings[word] = array('q')
+            keys.append(pack_key(caption_id, index))
+            lengths[caption_id] = length
+
+        for word, keys in postings.items():
+            postings[word] = array('q', sorted(keys))
+
+        variants = VariantIndex.from_counts((word, len(keys)) for word, keys in postings.items())
+        return cls(postings, lengths, variants=variants)
+
+    @classmethod
+    def from_database(cls, db):
+        start = time.time()
+        index = cls.from_rows(db.iter_words())
+        for caption_id, duration, timed in db.iter_captions():
+            index.durations[caption_id] = duration
+            if timed:
+                index.timed.add(caption_id)
+        index.logger.debug('Built phrase index of %d words over %d captions in %.2fs',
+                           len(index.postings), len(index.lengths), time.time() - start)
+        return index
+
+    @classmethod
+    def from_store(cls, store_dir):
+        # lookups go straight to the memory mapped files of a compiled store (see corpus_store.py)
+        from corpus_store import CorpusStore
+
+        start = time.time()
+        store = CorpusStore(store_dir)
+        index = cls(store.postings, store.lengths, store.durations, store.timed, store.variants)
+        index.logger.debug('Mapped phrase index of %d words over %d captions in %.3fs',
+                           len(index.postings), len(index.lengths), time.time() - start)
+        return index
+
+    def __contains__(self, word):
+        return word in self.postings
+
+    def find_existing_words(self, words):
+        return set(word for word in words if word in self.postings)
+
+    def find_variant(self, word, tiers=DEFAULT_TIERS):
+        # (corpus word, tier) standing in for a word the corpus lacks, None when there is none
+        if self.variants is None:
+            return None
+        return self.variants.find_variant(word, tiers)
+
+    def find_keys(self, words, start_index, max_keys=None):
+        # one sorted sequence per matched word j (starting at start_index) of the packed keys of every caption
+        # position where words[start_index:j+1] occurs, the position being words[j]'s. With max_keys, only that
+        # many random positions of a span are extended by a word just as common, so a run of common words costs
+        # the same whatever the corpus size, at the price of missing some of their rarer continuations
+        levels = []
+
+        keys = self.postings.get(words[start_index], ())
+        j = start_index
+        while len(keys):
+            levels.append(keys)
+
+            j += 1
+            if j >= len(words) or words[j] not in self.postings:
+                break
+
+            postings = self.postings[words[j]]
+            if max_keys is not None and len(keys) > max_keys and len(postings) > max_keys:
+                keys = sorted(sample_keys(keys, max_keys))
+            keys = intersect_next(keys, postings)
+
+        return levels
+
+    def find_ranges(self, words, start_index, sample=None, max_keys=None):
+        # find_keys as (caption_id, index, length) rows, of at most sample random positions per word when given
+        return [[unpack_key(key) + (self.lengths[key >> KEY_SHIFT],) for key in
+                 (keys if sample is None else sample_keys(keys, sample))]
+                for keys in self.find_keys(words, start_index, max_keys)]
@@ -0,0 +1,157 @@
+import logging
+import queue
+import threading
+import time
+
+from downloader import Downloader
+from manifest import Manifest
+from splitter import Splitter
+from storage import DATABASES, get_database, parse_video_captions
+
+# marks the end of a stage's input
+DONE = None
+
+def iter_queue(q):
+    while True:
+        item = q.get()
+        if item is DONE:
+            return
+        yield item
+
+class Pipeline:
+    # download -> parse -> ingest (-> split) with every video moving to the next stage as soon as it is ready
+    def __init__(self, debug=False, workers=4, split=False, queue_size=32, cache_bytes=10 * 1024**3, canonical=False,
+                 db='postgres', root_dir=None):
+        self.logger = logging.getLogger('pipeline')
+        self.logger.setLevel(logging.DEBUG)
+
+        # root_dir holds the videos and cache directories, the repository by default
+        self.db = get_database(db, debug=debug, root_dir=root_dir)
+        self.downloader = Downloader(debug=debug, workers=workers, root_dir=self.db.root_dir)
+        self.manifest = Manifest(self.db.root_dir, debug=debug)
+        self.splitter = Splitter(debug=debug, cache_bytes=cache_bytes, canonical=canonical,
+                                 root_dir=self.db.root_dir) if split else None
+
+        # bounded so a fast stage waits for a slow one instead of piling up work
+        self.downloaded = queue.Queue(maxsize=queue_size)
+        self.parsed = queue.Queue(maxsize=queue_size)
+        self.ingested = queue.Queue(maxsize=queue_size)
+
+        # the parse and ingest stages share the database connection
+        self.db_lock = threading.Lock()
+        # input queues of the stages which failed, nothing is put on them any more, and the errors raised by run()
+        self.dead_queues = set()
+        self.errors = []
+
+        self.start = None
+        self.n_ingested = 0
+
+        if debug:
+            stream_handler = logging.StreamHandler()
+            stream_handler.setLevel(logging.DEBUG)
+            self.logger.addHandler(stream_handler)
+
+    def put(self, q, item):
+        # a full queue would never empty again once its stage failed, the item is dropped then
+        while q not in self.dead_queues:
+            try:
+                q.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def run_stage(self, stage, input_queue):
+        # the earlier stages carry on without a failed stage, run() raises its error once they are done
+        try:
+            stage()
+        except BaseException as e:
+            self.logger.exception('%s failed', stage.__name__)
+            self.errors.append(e)
+            self.dead_queues.add(input_queue)
+
+    def parse_stage(self):
+        # DONE is always passed on, the later stages would wait for it forever otherwise
+        try:
+            for video_id in iter_queue(self.downloaded):
+                try:
+                    if self.db_ingested(video_id):
+                        rows = []
+                    else:
+                        _, rows = parse_video_captions(self.db.root_dir, video_id)
+                except Exception:
+                    self.logger.exception('Failed to parse %s', video_id)
+                    continue
+
+                if rows is not None:
+                    self.put(self.parsed, (video_id, rows))
+        finally:
+            self.put(self.parsed, DONE)
+
+    def db_ingested(self, video_id):
+        with self.db_lock:
+            return self.db.is_video_ingested(video_id)
+
+    def ingest_stage(self):
+        try:
+            for video_id, rows in iter_queue(self.parsed):
+                if rows:
+                    try:
+                        with self.db_lock:
+                            n_captions, n_words = self.db.ingest_video(rows)
+                        self.manifest.refresh(video_id)
+                        self.manifest.mark_ingested(video_id, n_captions)
+                    except Exception:
+                        self.logger.exception('Failed to ingest %s', video_id)
+                        continue
+                    self.n_ingested += 1
+                    self.logger.debug('%s searchable after %.1fs (%d captions, %d words), %d videos ingested',
+                                      video_id, time.time() - self.start, n_captions, n_words, self.n_ingested)
+
+                if self.splitter is not None:
+                    self.put(self.ingested, video_id)
+        finally:
+            self.put(self.ingested, DONE)
+
+    def split_stage(self):
+        self.splitter.split_videos(iter_queue(self.ingested))
+
+    def run(self, channel_id):
+        self.start = time.time()
+
+        stages = [(self.parse_stage, self.downloaded), (self.ingest_stage, self.parsed)]
+        if self.splitter is not None:
+            stages.append((self.split_stage, self.ingested))
+        threads = [threading.Thread(target=self.run_stage, args=stage, name=stage[0].__name__) for stage in stages]
+        for thread in threads:
+            thread.start()
+
+        try:
+            self.downloader.download_subtitle_channel(channel_id,
+                                                      on_done=lambda video_id: self.put(self.downloaded, video_id))
+        finally:
+            self.put(self.downloaded, DONE)
+            for thread in threads:
+                thread.join()
+
+        if self.errors:
+            raise self.errors[0]
+        self.logger.debug('Pipeline done in %.1fs, %d videos ingested', time.time() - self.start, self.n_ingested)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Download, populate and optionally split a channel in one go')
+    parser.add_argument('channel_id', help='Channel ID to fetch')
+    parser.add_argument('--workers', type=int, default=4, help='concurrent downloads (default: 4)')
+    parser.add_argument('--split', action='store_true', default=False, help='pre-split clips as videos are ingested')
+    parser.add_argument('--cache-gb', type=float, default=10, help='clip cache size budget in GB (default: 10)')
+    parser.add_argument('--canonical', action='store_true', default=False,
+                        help='encode clips to the canonical mash profile so merging them is a stream copy')
+    parser.add_argument('--db', choices=DATABASES, default='postgres',
+                        help='caption database, sqlite needs no server (default: postgres)')
+    args = parser.parse_args()
+
+    p = Pipeline(debug=True, workers=args.workers, split=args.split, cache_bytes=int(args.cache_gb * 1024**3),
+                 canonical=args.canonical, db=args.db)
+    p.run(args.channel_id)
@@ -0,0 +1,171 @@
+import logging
+
+from variants import DEFAULT_TIERS
+
+# most candidate captions of a span whose cost is looked at, they are picked at random
+MAX_CANDIDATES = 8
+# positions of a span looked at for those candidates, and most positions of a span extended by the next word
+# when both are common (see PhraseIndex.find_keys), they bound planning time however large the corpus is
+SAMPLED_POSITIONS = 256
+EXTENDED_POSITIONS = 1024
+
+class CostModel:
+    # rough seconds of work for every kind of action
+    cache_hit = 0.05
+    encode_overhead = 0.3
+    encode_per_second = 0.6
+    smart_encode_per_second = 0.15
+    # cutting words out of a caption lands on less natural boundaries than whole captions
+    cut_penalty = 0.3
+    synth_chunk = 2.5
+    # a near match sounds a little off, the looser the match the more (see variants.py)
+    variant_penalty = {'spelling': 0.1, 'stem': 0.8, 'phonetic': 1.5}
+    # a mash sounds better with real footage, so synthesizing is a little worse than its time suggests
+    synth_penalty = 1.0
+
+    def __init__(self, smart_cut=True):
+        self.smart_cut = smart_cut
+
+    def clip_cost(self, duration, cached):
+        if cached:
+            return self.cache_hit
+        per_second = self.smart_encode_per_second if self.smart_cut else self.encode_per_second
+        return self.encode_overhead + per_second * duration
+
+    def cut_cost(self, duration, cached):
+        return self.clip_cost(duration, cached) + self.cut_penalty
+
+    def synth_cost(self, cached):
+        if cached:
+            return self.cache_hit
+        return self.synth_chunk + self.synth_penalty
+
+
+class Planner:
+    def __init__(self, index, cost_model, cached_clips, cached_cuts, cached_synth, variants=DEFAULT_TIERS, debug=False):
+        # cached_clips(caption_ids) returns the subset of caption_ids already split and cached_cuts(cuts) the subset
+        # of (caption_id, first, last) cuts already made (both asked once per plan),
+        # cached_synth(text) whether text was already synthesized, variants the tiers of near matches
+        # words the corpus lacks may be swapped for (see variants.py), none for exact matches only
+        self.logger = logging.getLogger('planner')
+        self.logger.setLevel(logging.DEBUG)
+        self.index = index
+        self.cost_model = cost_model
+        self.cached_clips = cached_clips
+        self.cached_cuts = cached_cuts
+        self.cached_synth = cached_synth
+        self.variants = variants
+
+        if debug:
+            stream_handler = logging.StreamHandler()
+            stream_handler.setLevel(logging.DEBUG)
+            self.logger.addHandler(stream_handler)
+
+    def clip_candidates(self, words, start_index):
+        # (size, caption_ids, cuts) of every span starting at start_index, caption_ids being the captions it
+        # matches entirely and cuts (caption_id, first, last) word ranges it matches inside timed captions
+        candidates = []
+        # sampled at random, which also prevents the same clip from always being picked
+        for i, rows in enumerate(self.index.find_ranges(words, start_index, sample=SAMPLED_POSITIONS,
+                                                                max_keys=EXTENDED_POSITIONS)):
+            size = i + 1
+            caption_ids = []
+            cuts = []
+            for caption_id, index, length in rows:
+                if length == size and index == i:
+                    caption_ids.append(caption_id)
+                elif caption_id in self.index.timed and len(cuts) < MAX_CANDIDATES:
+                    cuts.append((caption_id, index - i, index))
+
+            candidates.append((size, caption_ids[:MAX_CANDIDATES], cuts))
+        return candidates
+
+    def near_words(self, words):
+        # words with the ones the corpus lacks swapped for their closest variant, and the penalty of every position
+        near = list(words)
+        penalties = [0] * len(words)
+        if not self.variants:
+            return near, penalties
+
+        for i, word in enumerate(words):
+            if word in self.index:
+                continue
+            variant = self.index.find_variant(word, self.variants)
+            if variant is not None:
+                near[i], tier = variant
+                penalties[i] = self.cost_model.variant_penalty[tier]
+        return near, penalties
+
+    def clip_options(self, words, i, candidates, cached, penalties=None):
+        # (cost, action, size) of the clip_candidates covering words[i:], penalized spans hold near matches
+        options = []
+        for size, caption_ids, cuts in candidates:
+            penalty = sum(penalties[i:i+size]) if penalties else 0
+            if penalties and not penalty:
+                continue # the same span matches exactly
+            near = {'near': words[i:i+size]} if penalties else {}
+
+            if caption_ids:
+                cost, caption_id = self.best_clip(caption_ids, cached)
+                options.append((cost + penalty, dict({'name': 'clip', 'caption_id': caption_id, 'size': size}, **near), size))
+            if cuts:
+                cost, (caption_id, first, last) = self.best_cut(cuts, cached)
+                options.append((cost + penalty, dict({'name': 'cut', 'caption_id': caption_id, 'first': first, 'last': last,
+                                                      'size': size}, **near), size))
+        return options
+
+    def best_clip(self, caption_ids, cached):
+        costs = [(self.cost_model.clip_cost(self.index.durations.get(caption_id, 0), caption_id in cached), caption_id)
+                 for caption_id in caption_ids]
+        return min(costs, key=lambda c: c[0])
+
+    def best_cut(self, cuts, cached):
+        # cut durations are estimated from the share of the caption's words they hold
+        costs = []
+        for cut in cuts:
+            caption_id, first, last = cut
+            duration = self.index.durations.get(caption_id, 0) * (last - first + 1) / self.index.lengths[caption_id]
+            costs.append((self.cost_model.cut_cost(duration, cut in cached), cut))
+        return min(costs, key=lambda c: c[0])
+
+    def plan(self, words):
+        n = len(words)
+        near, penalties = self.near_words(words)
+
+        # every span is looked up before the search, so the cache is asked about all of their captions at once
+        candidates = {}
+        for i in range(n):
+            candidates[i, False] = self.clip_candidates(words, i)
+            if near[i:] != words[i:]:
+                candidates[i, True] = self.clip_candidates(near, i)
+        # cached holds the caption_ids and the (caption_id, first, last) cuts already in the cache
+        caption_ids = {caption_id for spans in candidates.values() for _, ids, _ in spans for caption_id in ids}
+        cuts = {cut for spans in candidates.values() for _, _, span_cuts in spans for cut in span_cuts}
+        cached = (self.cached_clips(caption_ids) if caption_ids else set()) | (self.cached_cuts(cuts) if cuts else set())
+
+        # best[i] is the cheapest (cost, action, size) covering words[i:], filled from the end
+        best = [None] * n + [(0, None, 0)]
+        for i in range(n - 1, -1, -1):
+            options = []
+            for size in (1, 2):
+                if i + size <= n:
+                    text = ' '.join(words[i:i+size])
+                    cost = self.cost_model.synth_cost(self.cached_synth(text))
+                    options.append((cost, {'name': 'sythesize', 'words': words[i:i+size]}, size))
+
+            options += self.clip_options(words, i, candidates[i, False], cached)
+            if (i, True) in candidates:
+                options += self.clip_options(near, i, candidates[i, True], cached, penalties)
+
+            best[i] = min(((cost + best[i + size][0], action, size) for cost, action, size in options),
+                          key=lambda o: o[0])
+
+        actions = []
+        i = 0
+        while i < n:
+            _, action, size = best[i]
+            actions.append(action)
+            i += size
+
+        self.logger.debug('Planned %d actions for %d words, estimated cost %.2fs', len(actions), n, best[0][0] if n else 0)
+        return actions
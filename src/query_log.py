@@ -0,0 +1,87 @@
+import os
+import sqlite3
+import threading
+import time
+
+# longest run of consecutive requested words counted as a phrase
+MAX_PHRASE_WORDS = 3
+
+class QueryLog:
+    # what mashes ask for and which clips they resolve to, the warmer pre-splits from these counts
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS mash (
+                id                 INTEGER PRIMARY KEY,
+                text               TEXT NOT NULL,
+                n_words            INTEGER NOT NULL,
+                n_clips            INTEGER NOT NULL,
+                n_synthesized      INTEGER NOT NULL,
+                created            REAL NOT NULL
+            );
+
+            -- requested runs of words, whether or not the corpus had them
+            CREATE TABLE IF NOT EXISTS phrase (
+                text               TEXT PRIMARY KEY,
+                n_words            INTEGER NOT NULL,
+                hits               INTEGER NOT NULL,
+                last_used          REAL NOT NULL
+            );
+
+            -- clips mashes resolved to, first and last are -1 for whole captions
+            CREATE TABLE IF NOT EXISTS clip (
+                caption_id         INTEGER NOT NULL,
+                first              INTEGER NOT NULL,
+                last               INTEGER NOT NULL,
+                hits               INTEGER NOT NULL,
+                last_used          REAL NOT NULL,
+                PRIMARY KEY (caption_id, first, last)
+            );
+        """)
+
+    def record(self, text, words, actions):
+        now = time.time()
+        phrases = [' '.join(words[i:i+size]) for size in range(1, MAX_PHRASE_WORDS + 1)
+                   for i in range(len(words) - size + 1)]
+        clips = [(action['caption_id'], action.get('first', -1), action.get('last', -1)) for action in actions
+                 if action['name'] in ('clip', 'cut')]
+
+        with self.lock:
+            self.conn.execute('BEGIN')
+            self.conn.execute('INSERT INTO mash (text, n_words, n_clips, n_synthesized, created) VALUES (?, ?, ?, ?, ?)',
+                              (text, len(words), len(clips), len(actions) - len(clips), now))
+            self.conn.executemany("""
+                INSERT INTO phrase (text, n_words, hits, last_used) VALUES (?, ?, 1, ?)
+                ON CONFLICT (text) DO UPDATE SET hits = hits + 1, last_used = excluded.last_used
+            """, [(phrase, phrase.count(' ') + 1, now) for phrase in phrases])
+            self.conn.executemany("""
+                INSERT INTO clip (caption_id, first, last, hits, last_used) VALUES (?, ?, ?, 1, ?)
+                ON CONFLICT (caption_id, first, last) DO UPDATE SET hits = hits + 1, last_used = excluded.last_used
+            """, [clip + (now,) for clip in clips])
+            self.conn.execute('COMMIT')
+
+    def top_phrases(self, limit):
+        # [(words, hits)] most requested first
+        with self.lock:
+            rows = self.conn.execute('SELECT text, hits FROM phrase ORDER BY hits DESC, last_used DESC LIMIT ?',
+                                     (limit,)).fetchall()
+        return [(text.split(' '), hits) for text, hits in rows]
+
+    def top_clips(self, limit):
+        # [((caption_id, first, last), hits)] first and last None for whole captions
+        with self.lock:
+            rows = self.conn.execute('SELECT caption_id, first, last, hits FROM clip ORDER BY hits DESC, last_used DESC LIMIT ?',
+                                     (limit,)).fetchall()
+        return [((caption_id, None if first < 0 else first, None if last < 0 else last), hits)
+                for caption_id, first, last, hits in rows]
+
+    def stats(self):
+        with self.lock:
+            mashes, words, clips, synthesized = self.conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(n_words), 0), COALESCE(SUM(n_clips), 0), COALESCE(SUM(n_synthesized), 0) FROM mash'
+            ).fetchone()
+            phrases, = self.conn.execute('SELECT COUNT(*) FROM phrase').fetchone()
+        return {'mashes': mashes, 'words': words, 'clips': clips, 'synthesized': synthesized, 'phrases': phrases}
@@ -0,0 +1,279 @@
+import collections
+import json
+import logging
+import os
+import shutil
+import socket
+import socketserver
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import ffmpeg_runner
+from masher import Masher
+from storage import DATABASES
+from tracing import trace_summary, tracer
+from variants import DEFAULT_TIERS, TIERS
+from warmer import Warmer
+from tts import BACKENDS
+
+# finished jobs remembered for status requests, the oldest are forgotten first
+MAX_JOBS = 1000
+
+class MashJobs:
+    # mash jobs run on one warm Masher, each in its own temp dir until its video is complete
+    def __init__(self, masher, output_dir, jobs=2, debug=False):
+        self.logger = logging.getLogger('server')
+        self.logger.setLevel(logging.DEBUG)
+
+        self.masher = masher
+        self.output_dir = output_dir
+        self.work_dir = os.path.join(output_dir, 'tmp')
+        os.makedirs(self.work_dir, exist_ok=True)
+
+        self.pool = ThreadPoolExecutor(max_workers=jobs)
+        self.lock = threading.Lock()
+        self.jobs = collections.OrderedDict()
+        self.events = {}
+
+        if debug:
+            stream_handler = logging.StreamHandler()
+            stream_handler.setLevel(logging.DEBUG)
+            self.logger.addHandler(stream_handler)
+
+    def submit(self, text):
+        job_id = uuid.uuid4().hex
+        job = {
+            'id': job_id,
+            'text': text,
+            'state': 'queued',
+            'output': os.path.join(self.output_dir, job_id + '.mp4'),
+            'error': None,
+            'created': time.time(),
+            'started': None,
+            'finished': None,
+        }
+        with self.lock:
+            self.jobs[job_id] = job
+            self.events[job_id] = threading.Event()
+            self.forget_old()
+        self.pool.submit(self.run, job_id)
+        return dict(job)
+
+    def forget_old(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job['finished'] is not None]
+        for job_id in finished[:max(len(self.jobs) - MAX_JOBS, 0)]:
+            del self.jobs[job_id]
+            del self.events[job_id]
+
+    def update(self, job_id, **fields):
+        with self.lock:
+            self.jobs[job_id].update(fields)
+
+    def finish(self, job_id, **fields):
+        # marked finished and its waiters woken in one step, forget_old may drop the job right after
+        with self.lock:
+            job = self.jobs[job_id]
+            job.update(fields, finished=time.time())
+            self.events[job_id].set()
+            return dict(job)
+
+    def run(self, job_id):
+        job = self.get(job_id)
+        self.update(job_id, state='running', started=time.time())
+        tmp_dir = tempfile.mkdtemp(prefix=job_id, dir=self.work_dir)
+        fields = {'state': 'failed', 'error': 'interrupted'}
+        try:
+            # the output only appears once complete
+            os.replace(self.masher.mash(job['text'], os.path.join(tmp_dir, 'out.mp4')), job['output'])
+            fields = {'state': 'done'}
+        except Exception as e:
+            self.logger.exception('Job %s failed', job_id)
+            fields = {'state': 'failed', 'error': str(e)}
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            job = self.finish(job_id, **fields)
+
+        self.logger.debug('Job %s %s in %.1fs (%.1fs queued): "%s"', job_id, job['state'],
+                          job['finished'] - job['started'], job['started'] - job['created'], job['text'])
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return None if job is None else dict(job)
+
+    def wait(self, job_id, timeout=None):
+        with self.lock:
+            event = self.events.get(job_id)
+        if event is not None:
+            event.wait(timeout)
+        return self.get(job_id)
+
+    def busy(self):
+        with self.lock:
+            return any(job['finished'] is None for job in self.jobs.values())
+
+    def stats(self):
+        with self.lock:
+            states = collections.Counter(job['state'] for job in self.jobs.values())
+        return {
+            'jobs': dict(states),
+            'clip_cache': self.masher.clip_cache.stats(),
+            'synth_cache': self.masher.sythesizer.cache.stats(),
+            'queries': self.masher.query_log.stats(),
+            'ffmpeg': ffmpeg_runner.get_runner().stats(),
+            'trace': trace_summary(tracer.snapshot()) if tracer.enabled else None,
+        }
+
+    def warm_forever(self, warmer, interval):
+        # pre-splits likely clips every interval seconds, skipped while mashes are running
+        while True:
+            time.sleep(interval)
+            if self.busy():
+                continue
+            try:
+                warmer.run()
+            except Exception:
+                self.logger.exception('Warming failed')
+
+
+class MashRequestHandler(BaseHTTPRequestHandler):
+    # POST /mash {"text": ..., "wait": false}, GET /jobs/<id>, GET /stats, GET /trace
+    def send_json(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        if self.path != '/mash':
+            return self.send_json(404, {'error': 'not found'})
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            text = request['text'].strip()
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return self.send_json(400, {'error': 'expected a JSON body with a "text" string'})
+        if not text:
+            return self.send_json(400, {'error': 'text is empty'})
+
+        job = self.server.jobs.submit(text)
+        if request.get('wait'):
+            return self.send_json(200, self.server.jobs.wait(job['id']))
+        self.send_json(202, job)
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if parts == ['stats']:
+            return self.send_json(200, self.server.jobs.stats())
+        if parts == ['trace'] and tracer.enabled:
+            return self.send_json(200, tracer.to_chrome_trace())
+        if len(parts) == 2 and parts[0] == 'jobs':
+            job = self.server.jobs.get(parts[1])
+            if job is not None:
+                return self.send_json(200, job)
+        self.send_json(404, {'error': 'not found'})
+
+    def address_string(self):
+        # unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        self.server.jobs.logger.debug('%s - %s', self.address_string(), format % args)
+
+
+class MashServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, jobs):
+        self.jobs = jobs
+        super().__init__(address, MashRequestHandler)
+
+
+class UnixMashServer(MashServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        # HTTPServer.server_bind expects a (host, port) address
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve mashes over HTTP, with the index and caches kept warm')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on (default: 8080)')
+    parser.add_argument('--socket', default=None, help='listen on this unix socket instead of a TCP port')
+    parser.add_argument('--jobs', type=int, default=2, help='mashes run concurrently (default: 2)')
+    parser.add_argument('--output-dir', default=None, help='where mashes are written (default: out/)')
+    parser.add_argument('--cache-gb', type=float, default=10, help='clip cache size budget in GB (default: 10)')
+    parser.add_argument('--no-smart-cut', action='store_true', default=False,
+                        help='always re-encode whole clips instead of stream copying between keyframes')
+    parser.add_argument('--canonical', action='store_true', default=False,
+                        help='encode clips to the canonical mash profile so merging them is a stream copy')
+    parser.add_argument('--workers', type=int, default=None, help='clips split in parallel (default: cpu count)')
+    parser.add_argument('--tts', choices=sorted(BACKENDS), default='gtts', help='text to speech engine (default: gtts)')
+    parser.add_argument('--db', choices=DATABASES, default='postgres',
+                        help='caption database, sqlite needs no server (default: postgres)')
+    parser.add_argument('--store', default=None,
+                        help='compiled corpus store to look phrases up in instead of loading them from the database')
+    parser.add_argument('--warm-minutes', type=float, default=0,
+                        help='pre-split the most likely clips every this many idle minutes (default: never)')
+    parser.add_argument('--warm-budget-gb', type=float, default=1, help='most GB of clips added per warming (default: 1)')
+    parser.add_argument('--exact', action='store_true', default=False,
+                        help='only use clips of the exact words, never near matches like "run" for "running"')
+    parser.add_argument('--sound-alikes', action='store_true', default=False,
+                        help='also use words that sound and are spelled alike, like "color" for "colour"')
+    parser.add_argument('--ffmpeg-procs', type=int, default=None,
+                        help='ffmpeg processes run at once across every job (default: cpu count)')
+    parser.add_argument('--ffmpeg-timeout', type=float, default=None, help='seconds before an ffmpeg run is killed (default: none)')
+    parser.add_argument('--trace', default=None,
+                        help='record spans of every DB query, ffmpeg run, TTS call and merge, served on GET /trace '
+                             'and written to this file as a chrome trace on exit')
+    parser.add_argument('--debug', action='store_true', default=False)
+    args = parser.parse_args()
+
+    if args.trace:
+        tracer.enable()
+    ffmpeg_runner.configure(max_procs=args.ffmpeg_procs, timeout=args.ffmpeg_timeout, debug=args.debug)
+    script_dir = os.path.dirname(os.path.realpath(__file__))
+    output_dir = args.output_dir or os.path.realpath(os.path.join(script_dir, '..', 'out'))
+
+    # a connection per concurrently running clip fetch, plus one per job for planning
+    workers = args.workers or os.cpu_count()
+    m = Masher(debug=args.debug, cache_bytes=int(args.cache_gb * 1024**3), smart_cut=not args.no_smart_cut,
+               canonical=args.canonical, workers=args.workers, tts=args.tts, db=args.db,
+               db_pool=workers + args.jobs, store=args.store,
+               variants=() if args.exact else TIERS if args.sound_alikes else DEFAULT_TIERS)
+    jobs = MashJobs(m, output_dir, jobs=args.jobs, debug=args.debug)
+    if args.warm_minutes:
+        warmer = Warmer(m, max_bytes=int(args.warm_budget_gb * 1024**3), max_seconds=args.warm_minutes * 60,
+                        debug=args.debug)
+        threading.Thread(target=jobs.warm_forever, args=(warmer, args.warm_minutes * 60), daemon=True).start()
+
+    if args.socket is not None:
+        server = UnixMashServer(args.socket, jobs)
+        print('Listening on {}'.format(args.socket))
+    else:
+        server = MashServer((args.host, args.port), jobs)
+        print('Listening on http://{}:{}'.format(args.host, args.port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        m.db.close()
+        if args.trace:
+            tracer.write(args.trace)
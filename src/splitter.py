@@ -1,81 +1,411 @@
+import bisect
+import functools
+import json
 import logging
 import multiprocessing as mp
-import moviepy.editor as mop
-import re
 import os
+import shutil
+import tempfile
+import threading
 
-from utils import find_vtt_splits
+from clip_cache import ClipCache
+from ffmpeg_runner import get_runner
+from manifest import Manifest
+from tracing import file_size, tracer
+from utils import iter_vtt_cues
+
+# under this many seconds of keyframe aligned footage to stream copy a full re-encode is as cheap as a smart cut
+SMART_CUT_MIN_COPY = 2.0
+
+# every mash is rendered to this profile
+MASH_PROFILE = {
+    'width': 720,
+    'height': 480,
+    'fps': 30,
+    'sample_rate': 44100,
+    'channels': 2,
+    'gop': 60,
+}
+
+H264_PROFILES = {
+    'Constrained Baseline': 'baseline',
+    'Baseline': 'baseline',
+    'Main': 'main',
+    'High': 'high',
+}
+
+def input_files(args):
+    return [args[i + 1] for i, arg in enumerate(args[:-1]) if arg == '-i' and os.path.isfile(args[i + 1])]
+
+def run_traced(name, cmd, args, capture_stdout=False, timeout=None):
+    # a failure raises CalledProcessError holding ffmpeg's stderr instead of going unnoticed
+    with tracer.span(name, 'ffmpeg', args=' '.join(args)) as attrs:
+        attrs['bytes_in'] = sum(file_size(path) for path in input_files(args))
+        result = get_runner().run(cmd + args, timeout=timeout, capture_stdout=capture_stdout)
+        attrs['exit_code'] = result.returncode
+        attrs['cpu_seconds'] = result.cpu_seconds
+        tracer.count('ffmpeg.cpu_seconds', result.cpu_seconds)
+        if result.returncode != 0:
+            attrs['stderr'] = result.stderr.decode('utf-8', 'replace')[-2000:]
+            tracer.count('ffmpeg.failures')
+            result.check()
+        if not capture_stdout:
+            attrs['bytes_out'] = file_size(args[-1])
+    return result.stdout
+
+def run_ffmpeg(args, timeout=None):
+    # argv rather than a shell string so paths with spaces or quotes are fine, scheduled on the shared runner
+    run_traced('ffmpeg', ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y'], args, timeout=timeout)
+
+def run_ffprobe(args, timeout=None):
+    return run_traced('ffprobe', ['ffprobe', '-v', 'error'], args, capture_stdout=True, timeout=timeout).decode('utf-8')
+
+@functools.lru_cache(maxsize=256)
+def probe_streams(video_file):
+    out = run_ffprobe(['-show_entries',
+                       'stream=codec_type,codec_name,profile,width,height,pix_fmt,r_frame_rate,sample_rate,channels,duration',
+                       '-of', 'json', video_file])
+    streams = {}
+    for stream in json.loads(out).get('streams', []):
+        streams.setdefault(stream['codec_type'], stream)
+    return streams
+
+def probe_duration(media_file):
+    return float(run_ffprobe(['-show_entries', 'format=duration', '-of', 'csv=p=0', media_file]).strip())
+
+@functools.lru_cache(maxsize=256)
+def probe_keyframes(video_file):
+    # probed once per video and saved next to it, reading packet flags does not decode anything
+    cache_file = video_file + '.keyframes.json'
+    if os.path.isfile(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(video_file):
+        with open(cache_file) as f:
+            return tuple(json.load(f))
+
+    out = run_ffprobe(['-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0', video_file])
+    keyframes = []
+    for line in out.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags and pts_time not in ('', 'N/A'):
+            keyframes.append(float(pts_time))
+    keyframes.sort()
+
+    tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+    with open(tmp_file, 'w') as f:
+        json.dump(keyframes, f)
+    os.replace(tmp_file, cache_file)
+
+    return tuple(keyframes)
+
+def frame_duration(frame_rate):
+    # ffprobe rates are fractions like "30000/1001"
+    num, _, den = frame_rate.partition('/')
+    return float(den or 1) / float(num)
+
+def matching_encode_args(streams):
+    # encoder settings producing segments which can be concatenated with stream copied ones of the source
+    video = streams.get('video')
+    audio = streams.get('audio')
+    if video is None or video.get('codec_name') != 'h264' or video.get('profile') not in H264_PROFILES:
+        return None
+
+    args = ['-c:v', 'libx264', '-profile:v', H264_PROFILES[video['profile']],
+            '-pix_fmt', video['pix_fmt'], '-r', video['r_frame_rate']]
+    if audio is not None:
+        if audio.get('codec_name') != 'aac':
+            return None
+        args += ['-c:a', 'aac', '-ar', audio['sample_rate'], '-ac', str(audio['channels'])]
+    return args
+
+def canonical_encode_args():
+    # clips encoded with these settings (the canonical profile) are merged by a plain stream copy
+    p = MASH_PROFILE
+    return [
+        '-vf', 'scale={width}:{height},setsar=1,fps={fps}'.format(**p),
+        '-c:v', 'libx264', '-profile:v', 'high', '-pix_fmt', 'yuv420p', '-g', str(p['gop']), '-sc_threshold', '0',
+        '-c:a', 'aac', '-ar', str(p['sample_rate']), '-ac', str(p['channels']),
+    ]
+
+def is_canonical(streams):
+    p = MASH_PROFILE
+    return stream_profile(streams) == ('h264', 'High', p['width'], p['height'], 'yuv420p', '{}/1'.format(p['fps']),
+                                       'aac', str(p['sample_rate']), p['channels'])
+
+def clip_params(smart=False, canonical=False):
+    # everything changing how a clip is encoded, part of its cache key
+    params = ()
+    if smart:
+        params += ('smart',)
+    if canonical:
+        params += ('canonical',) + tuple(sorted(MASH_PROFILE.items()))
+    return params
+
+def split_video_vtt(video_file, s, e, clip_path, smart=False, canonical=False):
+    if canonical and not is_canonical(probe_streams(video_file)):
+        # a smart cut keeps the encoding of the source, here it has to change anyway
+        run_ffmpeg(['-ss', '{:.3f}'.format(s), '-i', video_file, '-t', '{:.3f}'.format(e - s)] +
+                   canonical_encode_args() + [clip_path])
+        return e - s
+
+    if smart:
+        return split_video_smart(video_file, s, e, clip_path)
 
-def split_video_vtt(video_file, s, e, clip_path):
     # moviepy's ffmpeg_extract_subclip does not re-trancode the video
     # resulting in very choppy footage so we will run it ourselves (note this is quite expensive)
-    cmd = (
-        "ffmpeg -ss {ss:.3f} -i {file} -t {len:.3f} {out} -hide_banner -loglevel error -y"
-    ).format(ss=s, file=video_file, len=e-s, out=clip_path)
+    run_ffmpeg(['-ss', '{:.3f}'.format(s), '-i', video_file, '-t', '{:.3f}'.format(e - s), clip_path])
+    return e - s
 
-    os.system(cmd)
+def split_video_smart(video_file, s, e, clip_path):
+    # only the head and tail around the keyframes inside [s, e] are re-encoded, the GOPs between them are copied
+    streams = probe_streams(video_file)
+    encode_args = matching_encode_args(streams)
+    keyframes = probe_keyframes(video_file)
+    first = bisect.bisect_left(keyframes, s)
+    last = bisect.bisect_right(keyframes, e) - 1
 
+    if encode_args is None or first >= len(keyframes) or last <= first \
+            or keyframes[last] - keyframes[first] < SMART_CUT_MIN_COPY:
+        return split_video_vtt(video_file, s, e, clip_path)
 
-def combine_videos(video_files, outfile):
-    tmp_files = []
+    # boundaries sit half a frame off the keyframes, a stream copy seeks back to the keyframe at or before its start
+    # so it has to start just past k1, and a rounded k2 must neither drop nor repeat the frame on it
+    k1, k2 = keyframes[first], keyframes[last]
+    half_frame = frame_duration(streams['video']['r_frame_rate']) / 2
+    with tempfile.TemporaryDirectory(prefix='smartcut') as tmp_dir:
+        segments = []
+        for seg_s, seg_e, args in [(s, k1 - half_frame, encode_args), (k1 + half_frame, k2 - half_frame, ['-c', 'copy']),
+                                   (k2 - half_frame, e, encode_args)]:
+            if seg_e - seg_s < 0.001:
+                continue
+            segment = os.path.join(tmp_dir, '{}.ts'.format(len(segments)))
+            run_ffmpeg(['-ss', '{:.6f}'.format(seg_s), '-i', video_file, '-t', '{:.6f}'.format(seg_e - seg_s)] + args +
+                       ['-bsf:v', 'h264_mp4toannexb', '-f', 'mpegts', segment])
+            segments.append(segment)
+
+        run_ffmpeg(['-i', 'concat:' + '|'.join(segments), '-c', 'copy', '-bsf:a', 'aac_adtstoasc', clip_path])
+
+    return e - s
+
+# the clip cache of a splitter worker process, opened once by init_split_worker
+worker_cache = None
+
+def init_split_worker(cache_dir, max_bytes):
+    global worker_cache
+    worker_cache = ClipCache(cache_dir, max_bytes, clean=False)
+
+def split_into_cache(cache, overwrite, smart, canonical, video_path, full_video_path, stamp, s, e):
+    key = ClipCache.clip_key(video_path, s, e, clip_params(smart, canonical), stamp)
+    split = lambda path: split_video_vtt(full_video_path, s, e, path, smart=smart, canonical=canonical)
+    if overwrite:
+        cache.put(key, split)
+    else:
+        cache.fetch(key, split)
+
+def split_job(job):
+    # (video_id, error or None), a failed clip must not abort the clips of every other video
+    video_id, args = job
+    try:
+        split_into_cache(worker_cache, *args)
+    except Exception as e:
+        return video_id, 'a clip of {} at {:.3f}s: {!r}'.format(args[4], args[-2], e)
+    return video_id, None
+
+
+def stream_profile(streams):
+    # what has to be identical between clips for them to be concatenated without re-encoding
+    video = streams.get('video', {})
+    audio = streams.get('audio', {})
+    return (
+        video.get('codec_name'), video.get('profile'), video.get('width'), video.get('height'),
+        video.get('pix_fmt'), video.get('r_frame_rate'),
+        audio.get('codec_name'), audio.get('sample_rate'), audio.get('channels'),
+    )
+
+def concat_copy(video_files, outfile, tmp_dir):
+    list_file = os.path.join(tmp_dir, 'clips.txt')
+    with open(list_file, 'w') as f:
+        for video_file in video_files:
+            f.write("file '{}'\n".format(os.path.abspath(video_file).replace("'", "'\\''")))
+
+    run_ffmpeg(['-f', 'concat', '-safe', '0', '-i', list_file, '-c', 'copy', '-movflags', '+faststart', outfile])
+
+def concat_filter(video_files, streams, outfile):
+    # a single ffmpeg decoding every clip, normalizing it to the mash profile and concatenating the lot
+    p = MASH_PROFILE
+    args = []
+    filters = []
     for i, video_file in enumerate(video_files):
-        tmp_file = 'tmp{}.ts'.format(i)
-        os.system('ffmpeg -i {} -c copy -bsf:v h264_mp4toannexb -f mpegts {} -hide_banner -loglevel error -y'.format(video_file, tmp_file))
-        tmp_files.append(tmp_file)
+        args += ['-i', video_file]
+        filters.append('[{i}:v]scale={width}:{height},setsar=1,fps={fps},format=yuv420p[v{i}]'.format(i=i, **p))
+        if 'audio' in streams[i]:
+            filters.append('[{i}:a]aresample={sample_rate},aformat=sample_fmts=fltp:channel_layouts=stereo[a{i}]'.format(i=i, **p))
+        else:
+            filters.append('anullsrc=r={sample_rate}:cl=stereo,atrim=duration={duration}[a{i}]'.format(
+                i=i, duration=streams[i]['video'].get('duration', 0), **p))
 
-    os.system('ffmpeg -i "concat:{}" -c copy -bsf:a aac_adtstoasc {} -hide_banner -loglevel error -y tmp.mp4'.format('|'.join(tmp_files), outfile))
-    os.system('ffmpeg -i tmp.mp4 -vf scale=720:480 -hide_banner -loglevel error -y {}'.format(outfile)) # force the scale to be 720x480
-    os.system('rm tmp.mp4 {}'.format(' '.join(tmp_files)))
+    filters.append('{}concat=n={}:v=1:a=1[v][a]'.format(
+        ''.join('[v{i}][a{i}]'.format(i=i) for i in range(len(video_files))), len(video_files)))
+
+    run_ffmpeg(args + ['-filter_complex', ';'.join(filters), '-map', '[v]', '-map', '[a]',
+                       '-c:v', 'libx264', '-c:a', 'aac', '-movflags', '+faststart', outfile])
+
+def combine_videos(video_files, outfile):
+    streams = [probe_streams(video_file) for video_file in video_files]
+    profiles = set(stream_profile(s) for s in streams)
+
+    # everything happens in a private temporary directory so concurrent mashes never share files
+    with tempfile.TemporaryDirectory(prefix='combine') as tmp_dir:
+        tmp_out = os.path.join(tmp_dir, 'out.mp4')
+
+        profile = profiles.pop() if len(profiles) == 1 else None
+        if profile is not None and profile[2:4] == (MASH_PROFILE['width'], MASH_PROFILE['height']):
+            concat_copy(video_files, tmp_out, tmp_dir)
+        else:
+            concat_filter(video_files, streams, tmp_out)
+
+        shutil.move(tmp_out, outfile)
 
 class Splitter:
-    def __init__(self, debug=False, overwrite=False):
+    def __init__(self, debug=False, overwrite=False, cache_bytes=10 * 1024**3, smart_cut=True, canonical=False,
+                 root_dir=None):
         self.logger = logging.getLogger('splitter')
         self.logger.setLevel(logging.DEBUG)
 
         self.overwrite = overwrite
+        self.smart_cut = smart_cut
+        self.canonical = canonical
         script_dir = os.path.dirname(os.path.realpath(__file__))
-        self.video_dir = os.path.realpath(os.path.join(script_dir, '..', 'videos'))
+        self.root_dir = root_dir or os.path.realpath(os.path.join(script_dir, '..'))
+        self.video_dir = os.path.join(self.root_dir, 'videos')
+        self.cache_dir = os.path.join(self.root_dir, 'cache', 'clips')
+        self.cache_bytes = cache_bytes
+        self.debug = debug
 
         if debug:
             stream_handler = logging.StreamHandler()
             stream_handler.setLevel(logging.DEBUG)
             self.logger.addHandler(stream_handler)
 
-    def split_base_videos(self):
-        args = []
-        for video_id in os.listdir(self.video_dir):
-            base_dir = os.path.join(self.video_dir, video_id)
-            files = os.listdir(base_dir)
+    def video_split_jobs(self, video_id, cache):
+        base_dir = os.path.join(self.video_dir, video_id)
+        files = os.listdir(base_dir)
 
-            vtt_file = next((os.path.join(base_dir, f) for f in files if f.endswith('vtt')), None)
-            video_file = next((os.path.join(base_dir, f) for f in files if f == video_id + '.mp4'), None)
+        vtt_file = next((os.path.join(base_dir, f) for f in files if f.endswith('vtt')), None)
+        video_file = next((os.path.join(base_dir, f) for f in files if f == video_id + '.mp4'), None)
 
-            # if there is not exaclty a VTT and video file, ignore
-            if len(files) < 2 or vtt_file is None or video_file is None:
-                self.logger.debug('Skipping video folder (%s)', base_dir)
-                continue
+        # if there is not exaclty a VTT and video file, ignore
+        if len(files) < 2 or vtt_file is None or video_file is None:
+            self.logger.debug('Skipping video folder (%s)', base_dir)
+            return None
+
+        # clips are keyed by the video path relative to the root, same as the masher does
+        video_path = os.path.join('videos', video_id, video_id + '.mp4')
+        params = clip_params(self.smart_cut, self.canonical)
+        stamp = ClipCache.source_stamp(video_file)
+        n_splits = ignored = 0
+        for i, s, e, caption, word_starts in iter_vtt_cues(vtt_file):
+            n_splits += 1
+            if self.overwrite or ClipCache.clip_key(video_path, s, e, params, stamp) not in cache:
+                yield (video_id, (self.overwrite, self.smart_cut, self.canonical, video_path, video_file, stamp, s, e))
+            else:
+                ignored += 1
+
+        self.logger.debug('Found %d splits for %s', n_splits, base_dir)
+        if ignored:
+            self.logger.debug('Ignoring %d/%d splits for (%s)', ignored, n_splits, base_dir)
+        return n_splits
+
+    def split_jobs(self, cache, video_ids, on_video_done):
+        # generated lazily so the pool starts splitting while later videos are still being parsed,
+        # on_video_done(video_id, n_splits) is called once every job of a video was handed out
+        for video_id in video_ids:
+            n_splits = yield from self.video_split_jobs(video_id, cache)
+            on_video_done(video_id, n_splits)
+
+    def split_videos(self, video_ids=None):
+        # videos new or changed since they were last split by default, video_ids can also be a generator of ids
+        # as they come
+        cache = ClipCache(self.cache_dir, self.cache_bytes)
+        manifest = Manifest(self.root_dir, debug=self.debug)
+        params = repr(clip_params(self.smart_cut, self.canonical))
+        if video_ids is None:
+            manifest.scan()
+            if self.overwrite:
+                video_ids = [video_id for video_id, _, _ in manifest.complete_videos()]
+            else:
+                video_ids = manifest.pending_split(params)
+            self.logger.debug('%d videos to split', len(video_ids))
+
+        # a video is recorded as split in the manifest once all of its jobs are generated and finished
+        # a video with a failed clip is not, so it is retried next time
+        lock = threading.Lock()
+        pending = {}
+        n_clips = {}
+        failed = set()
+
+        def finish(video_id, error=None):
+            with lock:
+                if error is not None:
+                    failed.add(video_id)
+                pending[video_id] -= 1
+                if pending[video_id]:
+                    return
+                del pending[video_id]
+                n_splits = n_clips.pop(video_id)
+                if video_id in failed:
+                    failed.discard(video_id)
+                    return
+            if n_splits is not None:
+                manifest.mark_split(video_id, params, n_splits)
 
-            splits = find_vtt_splits(vtt_file, base_dir)
-            self.logger.debug('Found %d splits for %s', len(splits), base_dir)
+        def on_video_done(video_id, n_splits):
+            with lock:
+                n_clips[video_id] = n_splits
+            finish(video_id)
 
-            ignored = 0
-            for split in splits:
-                i, s, e, caption = split
-                clip_path = os.path.join(base_dir, "clip{}.mp4".format(i))
-                if self.overwrite or not os.path.isfile(clip_path):
-                    args.append((video_file, s, e, clip_path))
+        def counted(video_ids):
+            # every video holds one extra count until on_video_done
+            for video_id in video_ids:
+                with lock:
+                    pending[video_id] = 1
+                yield video_id
+
+        def jobs():
+            for video_id, args in self.split_jobs(cache, counted(video_ids), on_video_done):
+                with lock:
+                    pending[video_id] += 1
+                yield video_id, args
+
+        n_cpus = max(mp.cpu_count() - 1, 1)
+        self.logger.debug('Starting to split segements on %d threads...', n_cpus)
+        n_split = n_failed = 0
+        with mp.Pool(n_cpus, initializer=init_split_worker, initargs=(self.cache_dir, self.cache_bytes)) as p:
+            for video_id, error in p.imap_unordered(split_job, jobs()):
+                if error is not None:
+                    self.logger.error('Failed to split %s', error)
+                    n_failed += 1
                 else:
-                    ignored += 1
+                    n_split += 1
+                finish(video_id, error)
+
+        self.logger.debug('Split %d segments, %d failed', n_split, n_failed)
+        self.logger.debug('Clip cache: %s', cache.stats())
 
-            if ignored:
-                self.logger.debug('Ignoring %d/%d splits for (%s)', ignored, len(splits), base_dir)
+    def split_base_videos(self):
+        self.split_videos()
 
-        n_cpus = mp.cpu_count() - 1
-        self.logger.debug('Starting to split %d segements on %d threads...', len(args), n_cpus)
-        with mp.Pool(n_cpus) as p:
-            p.starmap(split_video_vtt, args)
 
-    
 if __name__ == '__main__':
-    s = Splitter(debug=True, overwrite=False)
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Pre-split captioned videos into the clip cache')
+    parser.add_argument('--overwrite', action='store_true', default=False, help='re-split clips already cached')
+    parser.add_argument('--cache-gb', type=float, default=10, help='clip cache size budget in GB (default: 10)')
+    parser.add_argument('--no-smart-cut', action='store_true', default=False,
+                        help='always re-encode whole clips instead of stream copying between keyframes')
+    parser.add_argument('--canonical', action='store_true', default=False,
+                        help='encode clips to the canonical mash profile so merging them is a stream copy')
+    args = parser.parse_args()
+
+    s = Splitter(debug=True, overwrite=args.overwrite, cache_bytes=int(args.cache_gb * 1024**3),
+                 smart_cut=not args.no_smart_cut, canonical=args.canonical)
     s.split_base_videos()
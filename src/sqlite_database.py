@@ -0,0 +1,239 @@
+import json
+import os
+import sqlite3
+import threading
+
+from storage import Storage
+from tracing import traced
+from utils import caption_words, clean_caption_text
+
+# same queries as database.INDEX_CHECKS and the index EXPLAIN QUERY PLAN has to show for each of them,
+# word_word_idx holds caption_id and index as keys so it covers the range lookups too
+INDEX_CHECKS = [
+    ('SELECT word FROM word WHERE word IN (?, ?) GROUP BY word', ('the', 'and'), 'word_word_idx'),
+    ('SELECT * FROM word WHERE word = ?', ('the',), 'word_word_idx'),
+    ('SELECT * FROM word WHERE word = ? AND ((caption_id = ? AND "index" = ?) OR (caption_id = ? AND "index" = ?))',
+        ('the', 1, 0, 2, 0), 'word_word_idx'),
+    ('SELECT video_path, start_t, end_t, clip_path, word_starts FROM caption WHERE id = ?', (1,), 'PRIMARY KEY'),
+]
+
+class SqliteDatabase(Storage):
+    # embedded backend in a single file, same API as the Postgres Database without a server to talk to
+    def __init__(self, debug=False, path=None, root_dir=None):
+        super().__init__(debug=debug, root_dir=root_dir)
+        self.path = path or os.path.join(self.root_dir, 'cache', 'masher.db')
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+
+    def close(self):
+        self.conn.close()
+
+    def setup(self):
+        with self.lock:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS caption (
+                    id                 INTEGER PRIMARY KEY,
+                    vid_id             TEXT NOT NULL,
+                    "index"            INTEGER NOT NULL,
+                    raw_text           TEXT NOT NULL,
+                    text               TEXT NOT NULL,
+                    clip_path          TEXT NOT NULL,
+                    video_path         TEXT NOT NULL,
+                    converted          INTEGER NOT NULL,
+                    start_t            REAL NOT NULL,
+                    end_t              REAL NOT NULL,
+                    duration           REAL NOT NULL,
+                    priority           INTEGER NOT NULL,
+                    -- JSON list of the start time of each word, NULL when the captions have no word timing
+                    word_starts        TEXT,
+                    UNIQUE (vid_id, "index")
+                );
+
+                CREATE TABLE IF NOT EXISTS word (
+                    id                 INTEGER PRIMARY KEY,
+                    caption_id         INTEGER NOT NULL REFERENCES caption(id),
+                    word               TEXT NOT NULL,
+                    "index"            INTEGER NOT NULL,
+                    length             INTEGER NOT NULL
+                );
+
+                CREATE INDEX IF NOT EXISTS word_word_idx ON word (word, caption_id, "index", length);
+                CREATE INDEX IF NOT EXISTS word_caption_id_index_idx ON word (caption_id, "index");
+            """)
+
+    def migrate(self):
+        # the sqlite schema is created at its latest version
+        self.setup()
+
+    def check_indexes(self):
+        ok = True
+        with self.lock:
+            for query, args, index_name in INDEX_CHECKS:
+                plan = '\n'.join(row[-1] for row in self.conn.execute('EXPLAIN QUERY PLAN ' + query, args))
+                if index_name in plan:
+                    self.logger.debug('OK %s uses %s', query, index_name)
+                else:
+                    ok = False
+                    self.logger.warning('%s does not use %s:\n%s', query, index_name, plan)
+        return ok
+
+    def drop(self):
+        with self.lock:
+            self.conn.execute('DROP TABLE IF EXISTS word')
+            self.conn.execute('DROP TABLE IF EXISTS caption')
+
+    @traced('db')
+    def insert_syn(self, text, video_path, duration):
+        with self.lock:
+            syn_id, = self.conn.execute("""SELECT COALESCE(MAX("index"), 0) + 1 FROM caption WHERE vid_id = 'syn'""").fetchone()
+            self.ingest_video([(syn_id, 'syn', text, clean_caption_text(text), video_path, video_path, True, 0, duration,
+                                duration, 10, None)])
+
+    def insert_video_captions(self, rows):
+        # rows already present (same vid_id and index) are skipped so re-running a video is harmless
+        n_captions = n_words = 0
+        words_rows = []
+        for row in rows:
+            row = row[:-1] + (None if row[-1] is None else json.dumps(row[-1]),)
+            cur = self.conn.execute("""
+                INSERT INTO caption
+                    ("index", vid_id, raw_text, text, clip_path, video_path, converted, start_t, end_t, duration, priority,
+                     word_starts)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (vid_id, "index") DO NOTHING
+            """, row)
+            if cur.rowcount != 1:
+                continue
+
+            words = caption_words(row[3])
+            words_rows += [(cur.lastrowid, word, i, len(words)) for i, word in enumerate(words)]
+            n_captions += 1
+            n_words += len(words)
+
+        self.conn.executemany('INSERT INTO word (caption_id, word, "index", length) VALUES (?, ?, ?, ?)', words_rows)
+        return n_captions, n_words
+
+    @traced('db')
+    def ingest_video(self, rows):
+        with self.lock:
+            self.conn.execute('BEGIN')
+            try:
+                counts = self.insert_video_captions(rows)
+                self.conn.execute('COMMIT')
+            except Exception:
+                self.conn.execute('ROLLBACK')
+                raise
+        return counts
+
+    def is_video_ingested(self, video_id):
+        with self.lock:
+            return self.conn.execute('SELECT 1 FROM caption WHERE vid_id = ? LIMIT 1', (video_id,)).fetchone() is not None
+
+    def ingested_counts(self):
+        with self.lock:
+            return dict(self.conn.execute('SELECT vid_id, COUNT(*) FROM caption GROUP BY vid_id'))
+
+    def delete_video(self, video_id):
+        with self.lock:
+            self.conn.execute('BEGIN')
+            self.conn.execute('DELETE FROM word WHERE caption_id IN (SELECT id FROM caption WHERE vid_id = ?)', (video_id,))
+            self.conn.execute('DELETE FROM caption WHERE vid_id = ?', (video_id,))
+            self.conn.execute('COMMIT')
+
+    @traced('db')
+    def find_existing_words(self, words):
+        words = tuple(words)
+        with self.lock:
+            rows = self.conn.execute('SELECT word FROM word WHERE word IN ({}) GROUP BY word'.format(
+                ','.join('?' * len(words))), words).fetchall()
+        return set(w for w, in rows)
+
+    @traced('db')
+    def find_text_range(self, word, caption_index_filters=None, limit=None):
+        args = [word]
+        query = 'SELECT * FROM word WHERE word = ?'
+        if caption_index_filters is not None:
+            cond = []
+            for cap_id, index in caption_index_filters:
+                cond.append('(caption_id = ? AND "index" = ?)')
+                args += [cap_id, index]
+            query += ' AND (' + ' OR '.join(cond) + ')'
+
+        if limit is not None:
+            query += ' LIMIT ?'
+            args.append(limit)
+
+        with self.lock:
+            return self.conn.execute(query, args).fetchall()
+
+    def iter_rows(self, query, batch_size):
+        # fetched in batches so the whole table is never held in memory at once
+        cur = self.conn.cursor()
+        with self.lock:
+            cur.execute(query)
+        while True:
+            with self.lock:
+                rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+        cur.close()
+
+    def iter_words(self, batch_size=50000):
+        return self.iter_rows('SELECT caption_id, word, "index", length FROM word', batch_size)
+
+    def iter_captions(self, batch_size=50000):
+        return self.iter_rows('SELECT id, duration, word_starts IS NOT NULL FROM caption', batch_size)
+
+    @traced('db')
+    def find_captions_info(self, caption_ids):
+        caption_ids = tuple(caption_ids)
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT id, video_path, start_t, end_t, clip_path, word_starts FROM caption WHERE id IN ({})'.format(
+                    ','.join('?' * len(caption_ids))), caption_ids).fetchall()
+        return {row[0]: row[1:5] + (None if row[5] is None else json.loads(row[5]),) for row in rows}
+
+    @traced('db')
+    def find_caption_info(self, caption_id):
+        with self.lock:
+            row = self.conn.execute('SELECT video_path, start_t, end_t, clip_path, word_starts FROM caption WHERE id = ?',
+                                    (caption_id,)).fetchone()
+        if row is None:
+            return None
+        return row[:4] + (None if row[4] is None else json.loads(row[4]),)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Embedded SQLite database for masher')
+    parser.add_argument('action', choices=['setup', 's', 'populate', 'p', 'drop', 'd', 'explain', 'e'],
+                        help="""What to do
+                            setup (s): create tables to setup database
+                            drop (d): drop tables
+                            populate (p): fill database with caption data
+                            explain (e): check the masher queries use their indexes
+                        """)
+    parser.add_argument('--path', default=None, help='database file (default: cache/masher.db)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Processes parsing VTT files when populating (default: cpu count - 1)')
+    parser.add_argument('--full-scan', action='store_true', default=False,
+                        help='look into every video folder when populating, not only the ones changed since the last run')
+    args = parser.parse_args()
+
+    d = SqliteDatabase(debug=True, path=args.path)
+    if args.action.startswith('s'):
+        d.setup()
+    elif args.action.startswith('d'):
+        d.drop()
+    elif args.action.startswith('e'):
+        if not d.check_indexes():
+            raise SystemExit(1)
+    else:
+        d.setup()
+        d.populate(workers=args.workers, full_scan=args.full_scan)
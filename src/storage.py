@@ -0,0 +1,115 @@
+import functools
+import logging
+import multiprocessing as mp
+import os
+import time
+
+from manifest import Manifest
+from utils import clean_caption_text, iter_vtt_cues
+
+# storage backends of the caption and word tables, see get_database
+DATABASES = ('postgres', 'sqlite')
+
+def parse_video_captions(root_dir, video_id):
+    # runs in a worker process, returns the caption rows of a video ready to be inserted
+    base_dir = os.path.join(root_dir, 'videos', video_id)
+    files = os.listdir(base_dir)
+
+    vtt_file = next((os.path.join('videos', video_id, f) for f in files if f.endswith('vtt')), None)
+    video_file = next((os.path.join('videos', video_id, f) for f in files if f == video_id + '.mp4'), None)
+
+    # if there is not exaclty a VTT and video file, ignore
+    if len(files) < 2 or vtt_file is None or video_file is None:
+        return video_id, None
+
+    rows = []
+    for i, s, e, raw_text, word_starts in iter_vtt_cues(os.path.join(root_dir, vtt_file)):
+        clip_path = os.path.join('videos', video_id, "clip{}.mp4".format(i))
+        rows.append((i, video_id, raw_text, clean_caption_text(raw_text), clip_path, video_file, False, s, e, e - s, 100,
+                     word_starts))
+
+    return video_id, rows
+
+def get_database(name='postgres', debug=False, pool_size=None, path=None, root_dir=None):
+    # backends are imported on demand so the sqlite one works without psycopg2 installed
+    if name == 'postgres':
+        from database import Database
+        return Database(debug=debug, pool_size=pool_size, root_dir=root_dir)
+    if name == 'sqlite':
+        from sqlite_database import SqliteDatabase
+        return SqliteDatabase(debug=debug, path=path, root_dir=root_dir)
+    raise ValueError('Unknown database backend {} (choose from {})'.format(name, ', '.join(DATABASES)))
+
+
+class Storage:
+    # what every backend shares, a backend implements the rest of the Database API:
+    #   setup, drop, migrate, check_indexes, close, insert_syn, ingest_video, is_video_ingested, ingested_counts,
+    #   delete_video, find_existing_words, find_text_range, iter_words, iter_captions, find_captions_info,
+    #   find_caption_info
+    def __init__(self, debug=False, root_dir=None):
+        # root_dir holds the videos directory, the repository by default
+        self.logger = logging.getLogger('db')
+        self.logger.setLevel(logging.DEBUG)
+
+        script_dir = os.path.dirname(os.path.realpath(__file__))
+        self.root_dir = root_dir or os.path.realpath(os.path.join(script_dir, '..'))
+        self.video_dir = os.path.join(self.root_dir, 'videos')
+        self.debug = debug
+
+        if debug:
+            stream_handler = logging.StreamHandler()
+            stream_handler.setLevel(logging.DEBUG)
+            self.logger.addHandler(stream_handler)
+
+    def populate(self, workers=None, full_scan=False):
+        # only video folders new or changed since the last scan are looked into
+        manifest = Manifest(self.root_dir, debug=self.debug)
+        manifest.scan(full=full_scan)
+
+        # videos are committed one at a time, the ones already in the database were done by a previous run
+        done = self.ingested_counts()
+
+        video_ids = []
+        changed = []
+        for video_id, vtt_hash, ingested_hash in manifest.complete_videos():
+            if video_id not in done:
+                video_ids.append(video_id)
+            elif ingested_hash is None:
+                # ingested before the manifest existed
+                manifest.mark_ingested(video_id, done[video_id])
+            elif ingested_hash != vtt_hash:
+                changed.append(video_id)
+        self.logger.debug('Populating %d new and %d changed videos (%d already done)',
+                          len(video_ids), len(changed), len(done) - len(changed))
+
+        # captions of a video whose VTT changed are replaced as a whole
+        for video_id in changed:
+            self.delete_video(video_id)
+        video_ids += changed
+
+        n_workers = workers or max(mp.cpu_count() - 1, 1)
+        start = time.time()
+        n_captions = n_words = 0
+        parse = functools.partial(parse_video_captions, self.root_dir)
+        with mp.Pool(n_workers) as p:
+            for video_index, (video_id, rows) in enumerate(p.imap_unordered(parse, video_ids, chunksize=4)):
+                if rows is None:
+                    self.logger.debug('Skipping video folder (%s)', os.path.join(self.video_dir, video_id))
+                    continue
+
+                captions = 0
+                if rows:
+                    captions, words = self.ingest_video(rows)
+                    n_captions += captions
+                    n_words += words
+                manifest.mark_ingested(video_id, captions)
+
+                if video_index % 100 == 0:
+                    elapsed = max(time.time() - start, 1e-6)
+                    self.logger.debug('Progress Report: %s/%s (%.0f captions/s, %.0f words/s)',
+                                      video_index+1, len(video_ids), n_captions / elapsed, n_words / elapsed)
+
+        elapsed = max(time.time() - start, 1e-6)
+        self.logger.debug('Inserted %d captions and %d words in %.1fs (%.0f rows/s)',
+                          n_captions, n_words, elapsed, (n_captions + n_words) / elapsed)
+
@@ -1,47 +1,123 @@
 import logging
 import os
+import tempfile
+import threading
 
 import gizeh
-from gtts import gTTS
-import moviepy.editor as mpy
 
+from clip_cache import ClipCache
+from splitter import MASH_PROFILE, canonical_encode_args, probe_duration, run_ffmpeg
+from tracing import file_size, tracer
+from tts import BACKENDS, get_backend
 from utils import clean_caption_text
 
+FONT_FAMILY = 'Impact'
+VOICE = 'en'
+
 class Synthesizer:
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, canonical=False, tts='gtts', root_dir=None):
         self.logger = logging.getLogger('sytheizer')
         self.logger.setLevel(logging.DEBUG)
+        self.canonical = canonical
+        self.tts = get_backend(tts, VOICE)
+
+        # synthesized clips are referenced by syn captions in the database so they are never evicted
+        script_dir = os.path.dirname(os.path.realpath(__file__))
+        self.root_dir = root_dir or os.path.realpath(os.path.join(script_dir, '..'))
+        self.cache = ClipCache(os.path.join(self.root_dir, 'videos', 'syn'), max_bytes=None, debug=debug)
+        self.card_dir = os.path.join(self.root_dir, 'cache', 'cards')
+        os.makedirs(self.card_dir, exist_ok=True)
 
         if debug:
             stream_handler = logging.StreamHandler()
             stream_handler.setLevel(logging.DEBUG)
             self.logger.addHandler(stream_handler)
 
-    def sythesize_word(self, word, output_path):
-        clean = clean_caption_text(word).replace('.', '')
+    def fontsize(self, word):
+        return 90 if len(word) <= 13 else 50
 
-        self.logger.debug('Synthesizing "%s"...', clean)
-        tts = gTTS(text=clean, lang='en')
-        tts.save('tmp.mp3')
+    def clean(self, word):
+        return clean_caption_text(word).replace('.', '')
+
+    def cache_key(self, word):
+        profile = sorted(MASH_PROFILE.items()) if self.canonical else 'still24'
+        return ClipCache.make_key('syn', self.clean(word), self.tts.name, VOICE, FONT_FAMILY, self.fontsize(word), profile)
+
+    def fetch_many(self, words, pool=None):
+        # returns (path, duration, created) for each word, created meaning nothing had been synthesized
+        # for it before, the speech of every missing word is made by a single batch call to the TTS backend
+        # and their clips are rendered in parallel on pool when given
+        keys = [self.cache_key(word) for word in words]
+        paths = {key: self.cache.get(key) for key in keys}
+        missing = {}
+        for key, word in zip(keys, words):
+            if paths[key] is None:
+                missing.setdefault(key, word)
+
+        if missing:
+            self.logger.debug('Synthesizing speech of %d texts with %s...', len(missing), self.tts.name)
+            with tempfile.TemporaryDirectory(prefix='speech') as tmp_dir:
+                speech_paths = [os.path.join(tmp_dir, '{}.{}'.format(i, self.tts.extension)) for i in range(len(missing))]
+                with tracer.span('synthesize_batch', 'tts', backend=self.tts.name, texts=len(missing)) as attrs:
+                    self.tts.synthesize_batch([self.clean(word) for word in missing.values()], speech_paths)
+                    attrs['bytes_out'] = sum(file_size(path) for path in speech_paths)
+                tracer.count('tts.texts', len(missing))
+
+                def render(key, word, speech_path):
+                    return self.cache.put(key, lambda output_path: self.sythesize_word(word, output_path, speech_path))
+
+                renders = [(key, word, speech_path) for (key, word), speech_path in zip(missing.items(), speech_paths)]
+                if pool is None:
+                    rendered = [render(*args) for args in renders]
+                else:
+                    rendered = [future.result() for future in [pool.submit(render, *args) for args in renders]]
+                for (key, _, _), path in zip(renders, rendered):
+                    paths[key] = path
 
-        os.system('ffmpeg -i tmp.mp3 -c:a aac -hide_banner -loglevel error -y tmp.m4a')
-        audio_clip = mpy.AudioFileClip('tmp.m4a')
+        return [(paths[key], self.cache.duration(key), key in missing) for key in keys]
 
-        fontsize = 90 if len(word) <= 13 else 50
+    def fetch(self, word):
+        return self.fetch_many([word])[0]
+
+    def card_path(self, text, fontsize):
+        # title cards only depend on their text and size, each is drawn once and reused
+        key = ClipCache.make_key('card', text, FONT_FAMILY, fontsize)
+        path = os.path.join(self.card_dir, key + '.png')
+        if os.path.isfile(path):
+            return path
 
         surface = gizeh.Surface(720, 480) # width, height
-        text = gizeh.text(clean.capitalize(), fontfamily="Impact", fontsize=fontsize,
-                          fill=(1, 1, 1), xy=(360, 240))
+        text = gizeh.text(text, fontfamily=FONT_FAMILY, fontsize=fontsize, fill=(1, 1, 1), xy=(360, 240))
         text.draw(surface)
-        np_image = surface.get_npimage()
 
-        video_clip = mpy.VideoClip(lambda t: np_image, duration=audio_clip.duration)
-        video_clip = video_clip.set_audio(audio_clip)
-        video_clip.write_videofile(output_path, fps=24, audio_codec='aac')
-        os.remove('tmp.mp3')
-        os.remove('tmp.m4a')
+        tmp_path = '{}.tmp{}_{}.png'.format(path[:-4], os.getpid(), threading.get_ident())
+        surface.write_to_png(tmp_path)
+        os.replace(tmp_path, path)
+        return path
+
+    def encode_args(self):
+        if self.canonical:
+            return canonical_encode_args() + ['-tune', 'stillimage']
+        return ['-r', '24', '-c:v', 'libx264', '-tune', 'stillimage', '-pix_fmt', 'yuv420p', '-c:a', 'aac']
+
+    def sythesize_word(self, word, output_path, speech_path=None):
+        # speech_path is speech already synthesized for word
+        clean = self.clean(word)
+
+        self.logger.debug('Synthesizing "%s"...', clean)
+        with tempfile.TemporaryDirectory(prefix='synth') as tmp_dir:
+            if speech_path is None:
+                speech_path = os.path.join(tmp_dir, 'speech.{}'.format(self.tts.extension))
+                self.tts.synthesize(clean, speech_path)
+
+            duration = probe_duration(speech_path)
+            card_path = self.card_path(clean.capitalize(), self.fontsize(word))
+
+            # the card is a single still frame looped by the encoder, audio is muxed in the same pass
+            run_ffmpeg(['-loop', '1', '-i', card_path, '-i', speech_path, '-map', '0:v', '-map', '1:a',
+                        '-t', '{:.3f}'.format(duration)] + self.encode_args() + [output_path])
 
-        return audio_clip.duration
+        return duration
 
 if __name__ == '__main__':
     import argparse
@@ -50,7 +126,10 @@ if __name__ == '__main__':
     parser.add_argument('text', help='text')
     parser.add_argument('output', help='MP4 file path (default: "out.mp4")',
                         nargs='?', default='out.mp4')
+    parser.add_argument('--canonical', action='store_true', default=False,
+                        help='encode to the canonical mash profile')
+    parser.add_argument('--tts', choices=sorted(BACKENDS), default='gtts', help='text to speech engine (default: gtts)')
     args = parser.parse_args()
 
-    s = Synthesizer(debug=True)
+    s = Synthesizer(debug=True, canonical=args.canonical, tts=args.tts)
     s.sythesize_word(args.text, args.output)
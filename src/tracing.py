@@ -0,0 +1,118 @@
+import collections
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+# a long running server keeps only the latest spans, counters are never dropped
+MAX_SPANS = 100000
+
+class Tracer:
+    # spans (name, category, start, duration, attributes) and counters of what a process spent its time on,
+    # nothing is recorded until enable() so the spans cost next to nothing otherwise
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.spans = collections.deque(maxlen=MAX_SPANS)
+        self.counters = collections.Counter()
+
+    def enable(self):
+        self.enabled = True
+
+    def reset(self):
+        with self.lock:
+            self.start = time.perf_counter()
+            self.spans = collections.deque(maxlen=MAX_SPANS)
+            self.counters = collections.Counter()
+
+    @contextlib.contextmanager
+    def span(self, name, category, **attrs):
+        # the yielded attributes can be filled in while the span runs (bytes, cache hits, exit codes...)
+        if not self.enabled:
+            yield attrs
+            return
+
+        start = time.perf_counter()
+        try:
+            yield attrs
+        except BaseException as e:
+            attrs['error'] = repr(e)
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            with self.lock:
+                self.spans.append((name, category, start - self.start, duration, threading.get_ident(), attrs))
+                self.counters[category + '.count'] += 1
+                self.counters[category + '.seconds'] += duration
+
+    def count(self, name, value=1):
+        if self.enabled:
+            with self.lock:
+                self.counters[name] += value
+
+    def snapshot(self):
+        with self.lock:
+            return collections.Counter(self.counters)
+
+    def to_json(self):
+        with self.lock:
+            return {
+                'spans': [{'name': name, 'category': category, 'start': start, 'duration': duration, 'thread': tid,
+                           'attributes': attrs} for name, category, start, duration, tid, attrs in self.spans],
+                'counters': dict(self.counters),
+                'summary': trace_summary(self.counters),
+            }
+
+    def to_chrome_trace(self):
+        # complete events in the Trace Event Format, open with chrome://tracing or https://ui.perfetto.dev
+        pid = os.getpid()
+        with self.lock:
+            events = [{'name': name, 'cat': category, 'ph': 'X', 'ts': start * 1e6, 'dur': duration * 1e6,
+                       'pid': pid, 'tid': tid, 'args': attrs}
+                      for name, category, start, duration, tid, attrs in self.spans]
+            counters = dict(self.counters)
+        return {'traceEvents': events, 'displayTimeUnit': 'ms',
+                'otherData': {'counters': counters, 'summary': trace_summary(collections.Counter(counters))}}
+
+    def write(self, path, chrome=True):
+        with open(path, 'w') as f:
+            json.dump(self.to_chrome_trace() if chrome else self.to_json(), f, default=str)
+
+
+# the tracer of the process, every module records into it
+tracer = Tracer()
+
+def traced(category, name=None):
+    # decorator putting every call of a function in a span
+    def decorator(fn):
+        span_name = name or fn.__qualname__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with tracer.span(span_name, category):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def trace_summary(counters):
+    # the headline numbers of a trace: queries, ffmpeg runs and CPU seconds, synthesized texts, clip cache hits
+    return {
+        'db_queries': counters['db.count'],
+        'db_seconds': round(counters['db.seconds'], 3),
+        'ffmpeg_runs': counters['ffmpeg.count'],
+        'ffmpeg_cpu_seconds': round(counters['ffmpeg.cpu_seconds'], 3),
+        'ffmpeg_failures': counters['ffmpeg.failures'],
+        'tts_calls': counters['tts.count'],
+        'tts_texts': counters['tts.texts'],
+        'clip_cache_hits': counters['clip.cache_hits'],
+        'clip_cache_misses': counters['clip.cache_misses'],
+    }
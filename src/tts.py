@@ -0,0 +1,132 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import wave
+from array import array
+from xml.sax.saxutils import escape
+
+# pause put between the texts of a batch, long enough to never be mistaken for a pause inside a text
+BATCH_BREAK = 1.0
+# speech kept around a text when cutting it out of a batch
+BATCH_PADDING = 0.1
+
+class TTSBackend:
+    name = None
+    extension = None
+    # whether synthesize_batch is faster than synthesizing every text on its own
+    batches = False
+
+    def __init__(self, voice='en'):
+        self.voice = voice
+
+    def synthesize(self, text, output_path):
+        raise NotImplementedError
+
+    def synthesize_batch(self, texts, output_paths):
+        for text, output_path in zip(texts, output_paths):
+            self.synthesize(text, output_path)
+
+
+class GTTSBackend(TTSBackend):
+    name = 'gtts'
+    extension = 'mp3'
+
+    def synthesize(self, text, output_path):
+        from gtts import gTTS
+
+        tts = gTTS(text=text, lang=self.voice)
+        tts.save(output_path)
+
+
+class EspeakBackend(TTSBackend):
+    # local engine, no network access needed
+    name = 'espeak'
+    extension = 'wav'
+    batches = True
+
+    def __init__(self, voice='en'):
+        super().__init__(voice)
+        self.command = shutil.which('espeak-ng') or shutil.which('espeak')
+        if self.command is None:
+            raise RuntimeError('espeak-ng (or espeak) is not installed')
+
+    def synthesize(self, text, output_path):
+        subprocess.run([self.command, '-v', self.voice, '-w', output_path, text], check=True)
+
+    def synthesize_batch(self, texts, output_paths):
+        if len(texts) < 2:
+            return super().synthesize_batch(texts, output_paths)
+
+        # a single espeak run for the whole batch, texts separated by long breaks the audio is then cut at
+        with tempfile.TemporaryDirectory(prefix='tts') as tmp_dir:
+            batch_path = os.path.join(tmp_dir, 'batch.wav')
+            ssml = '<speak>{}</speak>'.format(
+                '<break time="{}ms"/>'.format(int(BATCH_BREAK * 1000)).join(escape(text) for text in texts))
+            subprocess.run([self.command, '-v', self.voice, '-m', '-w', batch_path, ssml], check=True)
+
+            silences = find_silences(batch_path, BATCH_BREAK * 0.6)
+            if len(silences) < len(texts) - 1:
+                return super().synthesize_batch(texts, output_paths)
+
+            # the longest silences are the breaks between texts
+            breaks = sorted(sorted(silences, key=lambda s: s[1] - s[0], reverse=True)[:len(texts) - 1])
+            bounds = [0] + [t for s, e in breaks for t in (s + BATCH_PADDING, e - BATCH_PADDING)] + [None]
+            for i, output_path in enumerate(output_paths):
+                slice_wav(batch_path, bounds[2*i], bounds[2*i + 1], output_path)
+
+
+BACKENDS = {
+    GTTSBackend.name: GTTSBackend,
+    EspeakBackend.name: EspeakBackend,
+}
+
+def get_backend(name, voice='en'):
+    if name not in BACKENDS:
+        raise ValueError('Unknown TTS backend {} (choose from {})'.format(name, ', '.join(BACKENDS)))
+    return BACKENDS[name](voice)
+
+def read_samples(wav_path):
+    with wave.open(wav_path, 'rb') as w:
+        params = w.getparams()
+        frames = w.readframes(w.getnframes())
+
+    if params.sampwidth != 2:
+        raise ValueError('Only 16 bit WAV files are supported ({})'.format(wav_path))
+
+    samples = array('h', frames)
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    return params, samples
+
+def find_silences(wav_path, min_duration, threshold=300, window=0.01):
+    params, samples = read_samples(wav_path)
+    step = max(int(params.framerate * window), 1) * params.nchannels
+
+    silences = []
+    start = None
+    for i in range(0, len(samples), step):
+        t = i / params.nchannels / params.framerate
+        quiet = max(map(abs, samples[i:i+step]), default=0) < threshold
+        if quiet and start is None:
+            start = t
+        elif not quiet and start is not None:
+            if t - start >= min_duration:
+                silences.append((start, t))
+            start = None
+
+    return silences
+
+def slice_wav(wav_path, s, e, output_path):
+    # e=None slices up to the end of the file
+    with wave.open(wav_path, 'rb') as w:
+        params = w.getparams()
+        start = int(s * params.framerate)
+        end = params.nframes if e is None else min(int(e * params.framerate), params.nframes)
+        w.setpos(start)
+        frames = w.readframes(max(end - start, 0))
+
+    with wave.open(output_path, 'wb') as out:
+        out.setparams(params)
+        out.writeframes(frames)
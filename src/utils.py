@@ -1,11 +1,15 @@
+import html
 import re
 import os
-from webvtt import WebVTT
 
-whitespace_regex = re.compile('\s+')
-parentheses_regex = re.compile('[\{\(\[].*?[\}\)\]]')
-colon_regex = re.compile('^.*:')
-alphanumeric_comma_regex = re.compile("[^a-zA-Z0-9_' \.]")
+whitespace_regex = re.compile(r'\s+')
+parentheses_regex = re.compile(r'[\{\(\[].*?[\}\)\]]')
+colon_regex = re.compile(r'^.*:')
+alphanumeric_comma_regex = re.compile(r"[^a-zA-Z0-9_' \.]")
+# YouTube's auto captions time every word: first<00:00:01.234><c> second</c><00:00:01.567><c> third</c>
+timestamp_tag_regex = re.compile(r'<(\d+:\d+:\d+\.\d+)>')
+tag_regex = re.compile(r'<[^>]*>')
+cue_timing_regex = re.compile(r'^((?:\d+:)?\d+:\d+\.\d+)\s+-->\s+((?:\d+:)?\d+:\d+\.\d+)')
 
 def clean_caption_text(text):
     text = whitespace_regex.sub(' ', text)
@@ -16,16 +20,102 @@ def clean_caption_text(text):
     return text.strip().lower()
 
 def convert_timestamp(ts):
-    h, m, s = ts.split(":")
+    parts = ts.split(":")
+    if len(parts) == 2: # hours are optional in VTT
+        parts.insert(0, '0')
+    h, m, s = parts
     return float(h)*3600 + float(m)*60 + float(s)
 
-def find_vtt_splits(vtt_file, out_dir):
-    captions = WebVTT().read(vtt_file)
+def plain_text(raw_text):
+    return html.unescape(tag_regex.sub('', raw_text))
 
-    splits = []
-    for i, caption in enumerate(captions):
-        s = convert_timestamp(caption.start)
-        e = convert_timestamp(caption.end)
-        splits.append((i, s, e, caption.text))
+def caption_words(text):
+    # removed characters can leave double spaces behind, they are not words
+    return [word for word in text.replace('.', '').split(' ') if word]
 
-    return splits
+def find_word_starts(raw_text, s):
+    # start time of every word of the cleaned caption, None unless the whole caption is timed
+    if not timestamp_tag_regex.search(raw_text):
+        return None
+
+    words = []
+    starts = []
+    t = s
+    for i, part in enumerate(timestamp_tag_regex.split(raw_text)):
+        if i % 2:
+            t = convert_timestamp(part)
+            continue
+
+        part_words = caption_words(clean_caption_text(plain_text(part)))
+        if i == 0 and len(part_words) > 1:
+            # only the first word is untagged (it starts with the cue), more means lines carried from the last cue
+            return None
+        words += part_words
+        starts += [t] * len(part_words)
+
+    if words != caption_words(clean_caption_text(plain_text(raw_text))):
+        return None
+    return starts
+
+def cut_times(word_starts, end_t, first, last):
+    # (start, end) of words first to last of a caption ending at end_t
+    return word_starts[first], word_starts[last + 1] if last + 1 < len(word_starts) else end_t
+
+def iter_vtt_blocks(vtt_file):
+    # (start, end, lines) of every cue, reading the file line by line
+    with open(vtt_file, encoding='utf-8-sig') as f:
+        timing = None
+        lines = []
+        for line in f:
+            # YouTube puts whitespace only lines inside cues, only a truly empty line ends one
+            line = line.rstrip('\r\n')
+            if not line:
+                if timing is not None:
+                    yield timing[0], timing[1], lines
+                timing = None
+                lines = []
+                continue
+
+            match = cue_timing_regex.match(line)
+            if match:
+                timing = convert_timestamp(match.group(1)), convert_timestamp(match.group(2))
+            elif timing is not None:
+                lines.append(line)
+
+        if timing is not None:
+            yield timing[0], timing[1], lines
+
+# most gap between two cues for the later one to be carrying lines of the earlier one
+ROLLING_GAP = 0.05
+
+def iter_vtt_cues(vtt_file):
+    # yields (i, s, e, text, word_starts) per caption. YouTube's auto captions roll every line through two cues
+    # (plus a 10ms one in between), so lines of a cue that follows the previous one without a gap and were already
+    # in it are dropped, and a cue left with nothing new extends the caption it repeats
+    previous = (None, [])
+    pending = None
+    i = 0
+    for s, e, lines in iter_vtt_blocks(vtt_file):
+        previous_end, previous_texts = previous
+        rolling = previous_end is not None and s <= previous_end + ROLLING_GAP
+        texts = [whitespace_regex.sub(' ', plain_text(line)).strip() for line in lines]
+        previous = (e, texts)
+
+        new_lines = [line for line, text in zip(lines, texts) if text and not (rolling and text in previous_texts)]
+        if not new_lines:
+            if pending is not None and plain_text('\n'.join(lines)).strip() == pending[3] and s <= pending[2] + ROLLING_GAP:
+                pending = pending[:2] + (max(e, pending[2]),) + pending[3:]
+            continue
+
+        if pending is not None:
+            # trim overlaps with the previous caption, unless that would leave nothing of this one
+            if max(s, pending[2]) < e:
+                s = max(s, pending[2])
+            yield pending
+            i += 1
+
+        raw_text = '\n'.join(new_lines)
+        pending = (i, s, e, plain_text(raw_text).strip(), find_word_starts(raw_text, s))
+
+    if pending is not None:
+        yield pending
@@ -0,0 +1,152 @@
+import re
+from collections import defaultdict
+
+# looser tiers come later, a word is only matched to a variant of the first tier that has one
+TIERS = ('spelling', 'stem', 'phonetic')
+# sound alikes are often other words altogether ("money" and "many"), they have to be asked for
+DEFAULT_TIERS = ('spelling', 'stem')
+
+# spoken forms captions and requests write differently, both sides are mapped to the same word. Forms that are
+# words of their own without the apostrophe ("cause", "till") are only matched with it
+CONTRACTIONS = {
+    'gonna': 'going',
+    'gotta': 'got',
+    'wanna': 'want',
+    'kinda': 'kind',
+    'sorta': 'sort',
+    'outta': 'out',
+    'lotta': 'lot',
+    'lemme': 'let',
+    'gimme': 'give',
+    "'cause": 'because',
+    'cuz': 'because',
+    'coz': 'because',
+    "'em": 'them',
+    "'bout": 'about',
+    'ya': 'you',
+    "'til": 'until',
+    'ok': 'okay',
+    'yep': 'yes',
+    'yup': 'yes',
+    'yeah': 'yes',
+    'nope': 'no',
+    '0': 'zero',
+    '1': 'one',
+    '2': 'two',
+    '3': 'three',
+    '4': 'four',
+    '5': 'five',
+    '6': 'six',
+    '7': 'seven',
+    '8': 'eight',
+    '9': 'nine',
+    '10': 'ten',
+}
+
+# longest first. Comparatives and agent nouns are left alone, too many are words of their own ("corner", "letter")
+SUFFIXES = ('ingly', 'edly', 'ing', 'ies', 'ied', 'ed', 'es', 'ly', 's')
+# a stem keeps at least MIN_STEM letters, shorter ones are mostly other words ("news", "does", "this"). Only a doubled
+# consonant before "ing" or "ed" marks a shorter one for certain ("running", "stopped")
+MIN_STEM = 4
+DOUBLING_SUFFIXES = ('ing', 'ed')
+# words which only look inflected, their stem is another word
+NOT_INFLECTED = {'evening', 'morning', 'united', 'wicked', 'whose'}
+# shorter words have too many sound alikes ("be", "by", "boy") to be swapped for one another
+MIN_PHONETIC = 4
+# most letters a sound alike differs by, soundex alone matches "being" and "bench" or "computer" and "compete"
+PHONETIC_MAX_EDITS = 1
+# most sound alikes of a word looked at, most frequent first
+MAX_PHONETIC_CANDIDATES = 20
+
+SOUNDEX_CODES = {letter: str(code) for code, letters in enumerate(('aeiouyhw', 'bfpv', 'cgjkqsxz', 'dt', 'l', 'mn', 'r'))
+                 for letter in letters}
+dropped_g_regex = re.compile("in'$")
+
+def spelling_key(word):
+    # "don't" and "dont", "runnin'" and "running", "gonna" and "going"
+    word = dropped_g_regex.sub('ing', word)
+    return CONTRACTIONS.get(word, word).replace("'", '')
+
+def stem_key(word):
+    # a crude suffix stripper, "running" and "run" share "run", "jumps" and "jumping" share "jump"
+    word = spelling_key(word)
+    if word in NOT_INFLECTED:
+        return word
+    for suffix in SUFFIXES:
+        stem = word[:-len(suffix)] + ('y' if suffix in ('ies', 'ied') else '')
+        if word.endswith(suffix) and len(stem) >= MIN_STEM and not (suffix == 's' and word.endswith('ss')):
+            word = stem
+            if suffix in DOUBLING_SUFFIXES and word[-1] == word[-2] and word[-1] not in 'lsz':
+                word = word[:-1]
+            break
+    if len(word) > MIN_STEM and word.endswith('e'):
+        word = word[:-1]
+    return word
+
+def phonetic_key(word):
+    # soundex, "their" and "there" share "t600", None for short words
+    word = spelling_key(word)
+    if len(word) < MIN_PHONETIC or not word.isalpha():
+        return None
+
+    codes = [SOUNDEX_CODES.get(letter, '0') for letter in word]
+    key = word[0]
+    last = codes[0]
+    for letter, code in zip(word[1:], codes[1:]):
+        if code != '0' and code != last:
+            key += code
+        if letter not in 'hw':
+            last = code
+    return (key + '000')[:4]
+
+def edit_distance(a, b):
+    previous = list(range(len(b) + 1))
+    for i, x in enumerate(a, 1):
+        current = [i]
+        for j, y in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (x != y)))
+        previous = current
+    return previous[-1]
+
+def sounds_alike(word, variant):
+    return edit_distance(word, variant) <= PHONETIC_MAX_EDITS
+
+KEYS = {'spelling': spelling_key, 'stem': stem_key, 'phonetic': phonetic_key}
+
+
+class VariantIndex:
+    def __init__(self, tables):
+        self.tables = tables # tier -> key -> corpus words sharing it, most frequent first
+
+    @classmethod
+    def from_counts(cls, counts):
+        # counts is an iterable of (word, occurrences) over the corpus vocabulary
+        grouped = {tier: defaultdict(list) for tier in TIERS}
+        for word, count in counts:
+            for tier in TIERS:
+                key = KEYS[tier](word)
+                if key is not None:
+                    grouped[tier][key].append((count, word))
+
+        tables = {tier: {key: [word for _, word in sorted(words, key=lambda w: (-w[0], w[1]))]
+                         for key, words in grouped[tier].items()}
+                  for tier in TIERS}
+        return cls(tables)
+
+    def to_json(self):
+        return self.tables
+
+    def find_variant(self, word, tiers=DEFAULT_TIERS):
+        # (corpus word, tier) closest to word, None when none of the tiers has another word for it
+        for tier in TIERS:
+            key = KEYS[tier](word) if tier in tiers else None
+            if key is None:
+                continue
+
+            variants = self.tables[tier].get(key, ())
+            if tier == 'phonetic':
+                variants = [variant for variant in variants[:MAX_PHONETIC_CANDIDATES] if sounds_alike(word, variant)]
+            for variant in variants:
+                if variant != word:
+                    return variant, tier
+        return None
@@ -0,0 +1,125 @@
+import logging
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from itertools import islice
+
+from phrase_index import unpack_key
+
+# whole captions of a requested phrase split ahead of time, the planner prefers cached ones so more are rarely used
+CLIPS_PER_PHRASE = 2
+
+class Warmer:
+    # pre-splits the clips the query log says are the most likely to be asked for, within a disk and CPU budget
+    def __init__(self, masher, top_n=200, max_bytes=1024**3, max_seconds=600, workers=1, debug=False):
+        self.logger = logging.getLogger('warmer')
+        self.logger.setLevel(logging.DEBUG)
+
+        self.masher = masher
+        self.top_n = top_n
+        self.max_bytes = max_bytes
+        # summed encode time of the clips, a clip is roughly one busy core for as long as it takes
+        self.max_seconds = max_seconds
+        self.workers = workers
+
+        if debug:
+            stream_handler = logging.StreamHandler()
+            stream_handler.setLevel(logging.DEBUG)
+            self.logger.addHandler(stream_handler)
+
+    def whole_captions(self, keys, n_words):
+        # captions of the positions in keys holding just the phrase, the cheap index check first
+        for key in keys:
+            caption_id, index = unpack_key(key)
+            if index == n_words - 1 and self.masher.index.lengths[caption_id] == n_words:
+                yield caption_id
+
+    def candidates(self):
+        # [(caption_id, first, last)] most likely first, clips mashes resolved to and whole captions of the most
+        # requested phrases
+        scores = defaultdict(float)
+        for clip, hits in self.masher.query_log.top_clips(self.top_n):
+            scores[clip] += hits
+
+        for words, hits in self.masher.query_log.top_phrases(self.top_n):
+            if any(word not in self.masher.index for word in words):
+                continue
+            levels = self.masher.index.find_keys(words, 0)
+            if len(levels) < len(words):
+                continue
+            caption_ids = list(islice(self.whole_captions(levels[-1], len(words)), CLIPS_PER_PHRASE))
+            if not caption_ids:
+                continue
+            for caption_id in caption_ids:
+                scores[(caption_id, None, None)] += hits / len(caption_ids)
+
+        return sorted(scores, key=lambda clip: scores[clip], reverse=True)[:self.top_n]
+
+    def run(self):
+        start = time.time()
+        n_clips = n_cached = 0
+        used_bytes = used_seconds = 0
+
+        candidates = iter(self.candidates())
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            running = {}
+            while True:
+                # the budgets are checked before every clip, the ones already running are let finish
+                within_budget = used_bytes < self.max_bytes and used_seconds < self.max_seconds
+                while within_budget and len(running) < self.workers:
+                    clip = next(candidates, None)
+                    if clip is None:
+                        break
+                    if self.masher.is_clip_cached(*clip):
+                        n_cached += 1
+                        continue
+                    key = ('clip', clip[0]) if clip[1] is None else ('cut',) + clip
+                    # shares the in flight clips of the masher so a mash never splits what the warmer is splitting
+                    running[self.masher.submit(pool, key, self.masher.fetch_clip, *clip)] = time.time()
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    used_seconds += time.time() - running.pop(future)
+                    try:
+                        used_bytes += os.path.getsize(future.result())
+                    except Exception:
+                        self.logger.exception('Failed to warm a clip')
+                        continue
+                    n_clips += 1
+
+        self.logger.debug('Warmed %d clips (%d already cached) in %.1fs: %.1f MB, %.1f encode seconds',
+                          n_clips, n_cached, time.time() - start, used_bytes / 1024**2, used_seconds)
+        return n_clips
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from masher import Masher
+    from storage import DATABASES
+
+    parser = argparse.ArgumentParser(description='Pre-split the clips mashes are most likely to ask for')
+    parser.add_argument('--top', type=int, default=200, help='most clips looked at (default: 200)')
+    parser.add_argument('--budget-gb', type=float, default=1, help='most GB of clips added (default: 1)')
+    parser.add_argument('--budget-minutes', type=float, default=10, help='most minutes of encoding (default: 10)')
+    parser.add_argument('--workers', type=int, default=1, help='clips split in parallel (default: 1)')
+    parser.add_argument('--cache-gb', type=float, default=10, help='clip cache size budget in GB (default: 10)')
+    parser.add_argument('--no-smart-cut', action='store_true', default=False,
+                        help='always re-encode whole clips instead of stream copying between keyframes')
+    parser.add_argument('--canonical', action='store_true', default=False,
+                        help='encode clips to the canonical mash profile so merging them is a stream copy')
+    parser.add_argument('--db', choices=DATABASES, default='postgres',
+                        help='caption database, sqlite needs no server (default: postgres)')
+    parser.add_argument('--store', default=None,
+                        help='compiled corpus store to look phrases up in instead of loading them from the database')
+    args = parser.parse_args()
+
+    m = Masher(debug=True, cache_bytes=int(args.cache_gb * 1024**3), smart_cut=not args.no_smart_cut,
+               canonical=args.canonical, db=args.db, store=args.store)
+    w = Warmer(m, top_n=args.top, max_bytes=int(args.budget_gb * 1024**3), max_seconds=args.budget_minutes * 60,
+               workers=args.workers, debug=True)
+    w.run()